@@ -9,6 +9,10 @@ from flask.ext.pagedown import PageDown
 from flask.ext.uploads import (UploadSet, IMAGES,
                                configure_uploads, patch_request_class)
 from config import config
+from .cache import PageCache
+from .categories import CategoryTree
+from .tasks import TaskQueue
+from .render import RenderCache
 
 
 moment = Moment()
@@ -17,6 +21,10 @@ mail = Mail()
 csrf = CsrfProtect()
 pagedown = PageDown()
 images = UploadSet('images', IMAGES)
+page_cache = PageCache()
+category_tree = CategoryTree()
+tasks = TaskQueue()
+render_cache = RenderCache()
 
 login_manager = LoginManager()
 login_manager.session_protection = 'strong'
@@ -49,6 +57,10 @@ def create_app(config_name='default'):
     pagedown.init_app(app)
     configure_uploads(app, images)
     patch_request_class(app, size = 2*1024*1024)
+    page_cache.init_app(app)
+    category_tree.init_app(app)
+    tasks.init_app(app)
+    render_cache.init_app(app)
 
     if not app.debug and not app.testing and not app.config['SSL_DISABLE']:
         from flask_sslify import SSLify
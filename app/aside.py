@@ -1,5 +1,26 @@
-from flask import render_template, Markup
-from .models.content import Category, Tag
+import time
+from flask import render_template, Markup, current_app
+from flask.ext.sqlalchemy import SignallingSession
+from sqlalchemy import func
+from . import db, category_tree
+from .models.content import Post, Category, Tag, PostCounter
+
+
+def state():
+    """
+    (last modified, count) of tags and then categories, and the last
+    change in tag counts, in one query: a summary of what the asides
+    show, for HTTP validators.
+    """
+    columns = []
+    for model in (Tag, Category):
+        columns.append(db.session.query(func.max(model.modified)).as_scalar())
+        columns.append(db.session.query(func.count(model.id)).as_scalar())
+    # tag cloud weights
+    columns.append(db.session.query(func.max(PostCounter.modified))
+                             .filter(PostCounter.scope == 'tag')
+                             .as_scalar())
+    return tuple(db.session.query(*columns).one())
 
 
 class Aside(object):
@@ -27,21 +48,70 @@ class CategoryList(Aside):
     template = 'category_list.html'
 
     def __call__(self, parent=None):
-        parent = Category.query.filter_by(name=parent).first()
-        categories = Category.query.filter_by(parent=parent).order_by(Category.name).all()
-        self.context['title'] = parent.name
+        if parent is None:
+            categories = category_tree.roots
+        else:
+            node = category_tree.find(parent)
+            categories = node.children if node is not None else []
+        self.context['title'] = parent
         self.context['categories'] = categories
         return super(CategoryList, self).__call__()
 
 
 class TagCloud(Aside):
+    """
+    The TAG_CLOUD_SIZE tags with most published posts, weighted 1 to 5.
+    Counts come from the post counters; the rendered cloud is kept
+    for TAG_CLOUD_TIMEOUT seconds, or until a post or tag changes.
+    """
     template = 'tag_cloud.html'
     title = u"Etiquetas"
+    weights = 5
+
+    def tags(self):
+        published = PostCounter.published
+        rows = db.session.query(Tag.name, Tag.slug, published)\
+                         .join(PostCounter, (PostCounter.scope == 'tag') &
+                                            (PostCounter.scope_id == Tag.id))\
+                         .filter(published > 0)\
+                         .order_by(published.desc(), Tag.name)\
+                         .limit(current_app.config['TAG_CLOUD_SIZE'])\
+                         .all()
+        if not rows:
+            return []
+        low, high = rows[-1].published, rows[0].published
+        spread = float(high - low) or 1.0
+        return sorted(({ 'name': row.name,
+                         'slug': row.slug,
+                         'weight': 1 + int(round((row.published - low) / spread
+                                                 * (self.weights - 1))) }
+                       for row in rows),
+                      key=lambda tag: tag['name'])
 
     def __call__(self):
-        tags = Tag.query.order_by(Tag.name).all()
-        self.context['tags'] = tags
-        return super(TagCloud, self).__call__()
+        cloud = current_app.extensions.get('tag_cloud')
+        if cloud is None or \
+           cloud[0] + current_app.config['TAG_CLOUD_TIMEOUT'] < time.time():
+            self.context['tags'] = self.tags()
+            cloud = (time.time(), super(TagCloud, self).__call__())
+            current_app.extensions['tag_cloud'] = cloud
+        return cloud[1]
+
+    @staticmethod
+    def on_after_flush(session, flush_context):
+        for obj in set(session.new) | set(session.deleted) | set(session.dirty):
+            if isinstance(obj, (Post, Tag)):
+                session.info['tag_cloud_invalidate'] = True
+                return
+
+    @staticmethod
+    def on_after_commit(session):
+        if session.info.pop('tag_cloud_invalidate', False):
+            current_app.extensions['tag_cloud'] = None
+
+
+db.event.listen(SignallingSession, "after_flush", TagCloud.on_after_flush)
+db.event.listen(SignallingSession, "after_commit", TagCloud.on_after_commit)
 
 
 one_step = OneStep()
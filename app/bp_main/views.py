@@ -1,39 +1,125 @@
 # -*- coding: utf-8 -*-
-from flask import request, render_template, current_app
+from flask import request, render_template, current_app, abort, url_for
+from flask.ext.sqlalchemy import Pagination
 from flask.ext.login import current_user
 from flask.views import View
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, subqueryload, defaultload, defer
 from . import main
+from .. import db, page_cache, aside
 from ..bp_post.forms import CommentForm, GuestCommentForm
-from ..models.users import User
-from ..models.content import Post, Category, Tag
-from ..helpers import get_or_404
+from ..models.users import Permission, User
+from ..models.content import Post, Category, Tag, Comment, PostCounter, post_tag
+from ..helpers import get_or_404, KeysetPagination, not_modified, add_validators
 
 
 class PostList(View):
+    decorators = [page_cache.cached]
+    # loading strategy for every relationship rendered in post_list.html;
+    # many-to-one's are joined, collections get their own query.
+    loading = {
+        'author': joinedload,
+        'category': joinedload,
+        'main_image': joinedload,
+        'tags': subqueryload,
+    }
+    # columns post_list.html never shows (set to () to load everything)
+    deferred = ('body_md', 'body_html', 'category.excerpt', 'main_image.caption')
+
     def __init__(self, **kwargs):
         super(PostList, self).__init__(**kwargs)
         self.title = None
+        self.scope = None # a PostCounter scope (or list of them), if any
 
     def query(self, **kwargs):
         raise NotImplementedError()
 
+    def options(self):
+        options = [strategy(key) for key, strategy in self.loading.items()]
+        for path in self.deferred:
+            relationship, _, column = path.rpartition('.')
+            if relationship:
+                options.append(defaultload(relationship).defer(column))
+            else:
+                options.append(defer(column))
+        return options
+
     def render_template(self, context):
         return render_template('post_list.html', **context)
 
-    def dispatch_request(self, **kwargs):
-        query = self.query(**kwargs).filter(Post.page.is_(False)).order_by(Post.created.desc())
-        page = request.args.get('page', 1, type=int)
+    def visibility(self):
+        """
+        SQL criterion for the posts current_user is allowed to see:
+        published ones, plus their own drafts (or everything for editors).
+        """
+        if current_user.can(Permission.EDIT_POST):
+            return None
+        if current_user.is_authenticated:
+            return (Post.status == True) | (Post.author_id == current_user.id)
+        return Post.status == True
+
+    def state(self, query):
+        """
+        Cheap summary of the listed posts, for HTTP validators.
+        """
+        if self.scope is not None:
+            return PostCounter.state(*self.scope)
+        return tuple(query.order_by(None)
+                          .with_entities(func.max(Post.modified),
+                                         func.count(Post.id),
+                                         func.max(Post.comments_modified),
+                                         func.sum(Post.comment_count))
+                          .one())
+
+    def count(self, query):
+        if self.scope is not None:
+            if current_user.can(Permission.EDIT_POST):
+                return PostCounter.get(*self.scope)
+            if current_user.is_anonymous:
+                return PostCounter.get(*self.scope, published=True)
+        return query.order_by(None).count()
+
+    def paginate(self, query):
         per_page = current_app.config['POSTS_PER_PAGE']
-        pagination = query.paginate(page, per_page=per_page, error_out=True)
+        if current_app.config['POSTS_KEYSET_PAGINATION']:
+            return KeysetPagination(query, (Post.created, Post.id), per_page,
+                                    after = request.args.get('after'),
+                                    before = request.args.get('before'))
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            abort(404)
+        items = query.order_by(Post.created.desc(), Post.id.desc())\
+                     .limit(per_page)\
+                     .offset((page - 1) * per_page)\
+                     .all()
+        if not items and page != 1:
+            abort(404)
+        return Pagination(query, page, per_page, self.count(query), items)
+
+    def dispatch_request(self, **kwargs):
+        query = self.query(**kwargs).filter(Post.page == False)
+        if self.scope is not None:
+            scope, ids = self.scope
+            if not isinstance(ids, (list, tuple)):
+                ids = [ids]
+            page_cache.depends(*['{0}:{1}'.format(scope, id) for id in ids])
+        visibility = self.visibility()
+        if visibility is not None:
+            query = query.filter(visibility)
+        response = not_modified(*(self.state(query) + aside.state()))
+        if response is not None:
+            return response
+        pagination = self.paginate(query.options(*self.options()))
         posts = pagination.items
         context = { 'title': self.title,
                     'pagination': pagination,
                     'posts': posts }
-        return self.render_template(context)
+        return add_validators(self.render_template(context))
 
 
 class IndexList(PostList):
     def query(self, **kwargs):
+        self.scope = ('index', 0)
         return Post.query
 
 
@@ -41,21 +127,50 @@ class AuthorList(PostList):
     def query(self, **kwargs):
         author = get_or_404(User, User.username == kwargs['username'])
         self.title = u"Posts by {}".format(author.name or author.username)
+        self.scope = ('author', author.id)
         return Post.query.filter_by(author=author)
 
 
 class TagList(PostList):
+    """
+    /tag/a for one tag, /tag/a+b for posts with every tag,
+    /tag/a,b for posts with any of them.
+    """
     def query(self, **kwargs):
-        tag = get_or_404(Tag, Tag.slug == kwargs['slug'])
-        self.title = u"Posts tagged {}".format(tag.name)
-        return Post.query.filter(Post.tags.contains(tag))
+        slug = kwargs['slug']
+        every = '+' in slug
+        slugs = set(slug.split('+' if every else ','))
+        tags = Tag.query.filter(Tag.slug.in_(slugs)).order_by(Tag.name).all()
+        if not slugs or len(tags) != len(slugs):
+            abort(404)
+        ids = [tag.id for tag in tags]
+        tagged = db.session.query(post_tag.c.post_id)\
+                           .filter(post_tag.c.tag_id.in_(ids))
+        if len(tags) == 1:
+            self.scope = ('tag', tags[0].id)
+        else:
+            # posts in several tags would be counted twice by the counters
+            page_cache.depends(*['tag:{}'.format(id) for id in ids])
+            if every:
+                tagged = tagged.group_by(post_tag.c.post_id)\
+                               .having(func.count(post_tag.c.tag_id) == len(ids))
+        self.title = u"Posts tagged {}".format(
+            (u" and " if every else u" or ").join(tag.name for tag in tags))
+        return Post.query.filter(Post.id.in_(tagged.subquery()))
 
 
 class CategoryList(PostList):
     def query(self, **kwargs):
         category = get_or_404(Category, Category.slug == kwargs['slug'])
         self.title = u"Posts under category {}".format(category.name)
-        return Post.query.filter_by(category=category)
+        if not current_app.config['CATEGORY_LIST_SUBTREE']:
+            self.scope = ('category', category.id)
+            return Post.query.filter_by(category=category)
+        # the category and its descendants, through the indexed path
+        subtree = [id for (id,) in db.session.query(Category.id)
+                                             .filter(Category.path.like(category.path + '%'))]
+        self.scope = ('category', subtree)
+        return Post.query.filter(Post.category_id.in_(subtree))
 
 
 main.add_url_rule('/',                  view_func=IndexList.as_view('index'))
@@ -65,10 +180,28 @@ main.add_url_rule('/category/<slug>',   view_func=CategoryList.as_view('category
 
 
 @main.route('/<slug>')
+@page_cache.cached
 def post(slug):
-    post = get_or_404(Post, Post.slug == slug)
+    row = db.session.query(Post.id, Post.modified).filter(Post.slug == slug).first()
+    if row is None:
+        abort(404)
+    comments = db.session.query(func.max(Comment.modified), func.count(Comment.id))\
+                         .filter(Comment.post_id == row.id)\
+                         .one()
+    response = not_modified(row.modified, *(comments + aside.state()))
+    if response is not None:
+        return response
+    page_cache.depends('post:{}'.format(row.id))
+    post = Post.query.get(row.id)
     if current_user.is_authenticated:
         form = CommentForm(post)
     else:
         form = GuestCommentForm(post)
-    return render_template('post.html', post=post, form=form)
+    comments = Comment.thread(post)
+    more_comments = None
+    if comments.next_cursor:
+        more_comments = url_for('post.comments', slug=post.slug,
+                                after=comments.next_cursor)
+    return add_validators(render_template('post.html', post=post, form=form,
+                                          comments=comments.items,
+                                          more_comments=more_comments))
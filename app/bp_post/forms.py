@@ -4,6 +4,7 @@ from flask.ext.wtf import Form
 from wtforms import StringField, TextAreaField, BooleanField, FormField, HiddenField, SelectField, FileField
 from wtforms.validators import Regexp, InputRequired, ValidationError
 from flask.ext.pagedown.fields import PageDownField
+from .. import category_tree
 from ..forms import BaseForm, InlineForm, ModalForm
 from ..models.content import Post, Category, Image, Comment
 
@@ -38,13 +39,7 @@ class PostForm(BaseForm):
     def __init__(self, **kwargs):
         super(PostForm, self).__init__(**kwargs)
         self.categories.old.choices = [(0, u"No category")]
-        stack = Category.query.filter_by(parent_id=None)\
-                              .order_by(Category.name.desc())\
-                              .all()
-        while stack:
-            e = stack.pop()
-            if e.children:
-                stack.extend(e.children)
+        for e in category_tree.walk():
             self.categories.old.choices.append( (e.id, e.tree(linked=False)) )
 
     def validate_tags(self, field):
@@ -144,8 +139,13 @@ class CommentForm(BaseForm):
         self.post = post
 
     def validate_parent_id(self, field):
+        self.parent = None
+        if not field.data:
+            return
         parent = Comment.query.get(str(field.data))
-        self.parent = parent or None
+        if parent is None or parent.post_id != getattr(self, 'post', parent).id:
+            raise ValidationError(u"Invalid comment.")
+        self.parent = Comment.parent_for(parent)
 
 
 class GuestCommentForm(CommentForm):
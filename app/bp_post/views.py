@@ -3,21 +3,37 @@ from flask import render_template, redirect, url_for, flash, request, jsonify
 from flask.ext.login import login_required, current_user
 from . import post
 from .forms import PostForm, DeletePostForm, StatusForm, DropForm, CommentForm, GuestCommentForm
-from .. import db, images
+from .. import db, page_cache
 from ..models.users import Permission
 from ..models.content import Post, Category, Tag, Image, Comment
-from ..decorators import permission_required
+from ..decorators import permission_required, retry_on_conflict
 from ..helpers import get_or_404 # necessary?
 
 
 # helpers
 def set_tags(post, tags):
-    for name in tags:
-        tag = Tag.query.filter_by(name=name).first()
-        if tag is None:
-            tag = Tag(name=name)
-            db.session.add(tag)
-        post.tags.append(tag)
+    """
+    Make post.tags match the list of tag names: existing tags are
+    resolved in one query, missing ones are created, and only the
+    post_tag rows that actually change get written.
+    """
+    names = []
+    for name in tags or []:
+        if name not in names:
+            names.append(name)
+    with db.session.no_autoflush:
+        found = Tag.query.filter(Tag.name.in_(names)).all() if names else []
+        by_name = dict((tag.name, tag) for tag in found)
+        for name in names:
+            if name not in by_name:
+                by_name[name] = Tag(name=name)
+                db.session.add(by_name[name])
+        wanted = [by_name[name] for name in names]
+        for tag in [tag for tag in post.tags if tag not in wanted]:
+            post.tags.remove(tag)
+        for tag in wanted:
+            if tag not in post.tags:
+                post.tags.append(tag)
 
 
 def set_categories(post, old, new):
@@ -49,6 +65,7 @@ def set_categories(post, old, new):
 @post.route('/write', methods=["GET", "POST"])
 @login_required
 @permission_required(Permission.WRITE_POST)
+@retry_on_conflict()
 def write():
     form = PostForm()
     drop_form = DropForm()
@@ -79,6 +96,7 @@ def write():
 
 @post.route('/edit/<slug>', methods=["GET", "POST"])
 @login_required
+@retry_on_conflict()
 def edit(slug):
     post = get_or_404(Post, Post.slug == slug)
     form = PostForm(obj=post)
@@ -88,10 +106,9 @@ def edit(slug):
         post.excerpt = form.excerpt.data
         post.body_md = form.body_md.data
         # tags
-        post.tags[:] = []
         set_tags(post, form._tag_list)
         # categories
-        set_categories(post, form.old_category.data, form._category_list)
+        set_categories(post, form.categories.old.data, form.categories._list)
         #
         if form._main_image is not None:
             post.main_image = form._main_image
@@ -103,7 +120,7 @@ def edit(slug):
     old_photos = Image.query.filter(~Image.id.in_([i.id for i in post.images])).all()
     form.tags.data = ", ".join([tag.name for tag in post.tags])
     if post.category is not None:
-        form.old_category.data = post.category.id
+        form.categories.old.data = post.category.id
     return render_template('write_post.html',
                            form=form,
                            drop_form=drop_form,
@@ -137,17 +154,35 @@ def delete(slug):
 
 @post.route('/file/_upload', methods=["POST"])
 @login_required
+@retry_on_conflict()
 def _upload():
     form = DropForm()
     if form.validate_on_submit():
-        filename = images.save(request.files['file'])
-        i = Image(
-            filename=filename,
+        i = Image.from_upload(
+            request.files['file'],
             alternative = form.alternative.data,
             caption = form.caption.data,
         )
+        duplicate = i.id is not None # an Image already stored that file
         db.session.add(i)
-        return jsonify(filename=i.filename, tag=i.img())
+        db.session.commit()
+        return jsonify(filename=i.filename, tag=i.img(), duplicate=duplicate)
+
+
+@post.route('/<slug>/comments')
+@page_cache.cached
+def comments(slug):
+    """
+    A page of comment threads, as HTML, with the URL of the next one.
+    """
+    post = get_or_404(Post, Post.slug == slug)
+    page_cache.depends('post:{}'.format(post.id))
+    page = Comment.thread(post, after=request.args.get('after'))
+    next_url = None
+    if page.next_cursor:
+        next_url = url_for('post.comments', slug=slug, after=page.next_cursor)
+    return jsonify(html=render_template('_comment.html', comments=page.items),
+                   next=next_url)
 
 
 @post.route('/<slug>/comment', methods=["POST"])
@@ -167,8 +202,6 @@ def _comment(slug):
             c.author_email = form.author_email.data
             c.author_name = form.author_name.data
             c.author_url = form.author_url.data
-        c.post.comment_count = len(c.post.comments)
         db.session.add(c)
         db.session.commit()
-        print c()
         return jsonify(comment=c())
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import time
+import errno
+import pickle
+import tempfile
+from uuid import uuid4
+from hashlib import md5
+from threading import Lock
+from functools import wraps
+from collections import OrderedDict
+from flask import current_app, request, session, g
+from flask.ext.login import current_user
+from flask.ext.wtf.csrf import generate_csrf
+
+
+# BACKENDS
+###########################################################
+class LRUCache(object):
+    """
+    In-process backend: a bounded, thread-safe LRU dictionary.
+    Every worker process keeps (and invalidates) its own copy,
+    so use it with a single process or a short timeout.
+    """
+    def __init__(self, size=500):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._items.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                return None
+            self._items[key] = (expires, value) # most recently used
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (expires, value)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class FileSystemCache(object):
+    """
+    Backend shared by every process on the machine: one pickle file
+    per key within a directory of its own. Expired files go when read;
+    past threshold files, set() drops the expired ones, then the least
+    recently written, down to 90% of it.
+    """
+    def __init__(self, directory, threshold=5000):
+        self.directory = directory
+        self.threshold = threshold
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, md5(key.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _files(self):
+        paths = (os.path.join(self.directory, filename)
+                 for filename in os.listdir(self.directory))
+        return [path for path in paths if os.path.isfile(path)]
+
+    def _prune(self, written):
+        paths = self._files()
+        if len(paths) <= self.threshold:
+            return
+        now = time.time()
+        kept = []
+        for path in paths:
+            if path == written:
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    expires, value = pickle.load(f)
+                mtime = os.path.getmtime(path)
+            except (IOError, OSError, EOFError, pickle.PickleError):
+                expires, mtime = now, now
+            if expires is not None and expires <= now:
+                self._remove(path)
+            else:
+                kept.append((mtime, path))
+        kept.sort()
+        for mtime, path in kept[:max(0, len(kept) + 1 - self.threshold * 9 // 10)]:
+            self._remove(path)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.PickleError):
+            return None
+        if expires is not None and expires < time.time():
+            self._remove(path)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self._path(key)) # atomic
+        self._prune(self._path(key))
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def clear(self):
+        for path in self._files():
+            self._remove(path)
+
+
+# PAGE CACHE
+###########################################################
+class PageCache(object):
+    """
+    Full-page cache for anonymous GET requests, keyed on URL
+    and query string. Opt-in through PAGE_CACHE_TYPE:
+        None (disabled),
+        'lru' (in-process),
+        'filesystem' (PAGE_CACHE_DIR, up to PAGE_CACHE_THRESHOLD files).
+
+    Pages declare what they show with depends('post:1', 'tag:3'...);
+    invalidate() gives those names a new version, which turns
+    every page depending on them stale. Every page depends on 'all'.
+    """
+    backends = {
+        'lru': lambda app: LRUCache(app.config['PAGE_CACHE_SIZE']),
+        'filesystem': lambda app: FileSystemCache(app.config['PAGE_CACHE_DIR'],
+                                                  app.config['PAGE_CACHE_THRESHOLD']),
+    }
+    # per-session CSRF tokens are swapped for this when storing a page
+    csrf_placeholder = '__page_cache_csrf_token__'
+    csrf_pattern = re.compile(r'(name="csrf_token" type="hidden" value=")[^"]*(")')
+    kept_headers = ('ETag', 'Last-Modified', 'Cache-Control', 'Vary')
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PAGE_CACHE_TYPE', None)
+        app.config.setdefault('PAGE_CACHE_SIZE', 500)
+        app.config.setdefault('PAGE_CACHE_DIR', None)
+        app.config.setdefault('PAGE_CACHE_THRESHOLD', 5000)
+        app.config.setdefault('PAGE_CACHE_TIMEOUT', 300)
+        backend = None
+        if app.config['PAGE_CACHE_TYPE'] is not None:
+            backend = self.backends[app.config['PAGE_CACHE_TYPE']](app)
+        app.extensions['page_cache'] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions.get('page_cache')
+
+    def _cacheable(self):
+        return request.method == 'GET' \
+               and current_user.is_anonymous \
+               and '_flashes' not in session
+
+    def _fresh(self, entry):
+        for name, version in entry['versions'].items():
+            if self.backend.get('version:' + name) != version:
+                return False
+        return True
+
+    def _version(self, name):
+        version = self.backend.get('version:' + name)
+        if version is None:
+            version = uuid4().hex
+            self.backend.set('version:' + name, version)
+        return version
+
+    def depends(self, *names):
+        """
+        Declare what the page being rendered shows, before reading it:
+        the versions are taken now, so that an invalidation committed
+        while the page renders leaves the stored copy stale.
+        """
+        if hasattr(g, 'page_cache_depends'):
+            for name in names:
+                if name not in g.page_cache_depends:
+                    g.page_cache_depends[name] = self._version(name)
+
+    def invalidate(self, *names):
+        if self.backend is not None:
+            for name in names:
+                self.backend.set('version:' + name, uuid4().hex)
+
+    def cached(self, f):
+        """
+        Use as a decorator for views whose output only depends on
+        the URL for logged-out readers.
+        """
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if self.backend is None or not self._cacheable():
+                return f(*args, **kwargs)
+            key = 'page:' + request.full_path
+            entry = self.backend.get(key)
+            if entry is not None and self._fresh(entry):
+                body = entry['body'].replace(self.csrf_placeholder, generate_csrf())
+                response = current_app.response_class(body,
+                                                      mimetype = entry['mimetype'],
+                                                      headers = entry['headers'])
+                return response.make_conditional(request)
+            g.page_cache_depends = { 'all': self._version('all') }
+            response = current_app.make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not response.direct_passthrough:
+                body = self.csrf_pattern.sub(r'\g<1>' + self.csrf_placeholder + r'\g<2>',
+                                             response.get_data())
+                entry = { 'body': body,
+                          'mimetype': response.mimetype,
+                          'headers': [(k, v) for k, v in response.headers
+                                      if k in self.kept_headers],
+                          'versions': g.page_cache_depends }
+                self.backend.set(key, entry, current_app.config['PAGE_CACHE_TIMEOUT'])
+            return response
+        return decorated_function
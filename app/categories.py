@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from threading import Lock
+from sqlalchemy import func
+from flask import current_app, url_for, Markup, g
+
+
+class CategoryNode(object):
+    """
+    Read-only, session-free copy of a category,
+    as kept in the category tree.
+    """
+    def __init__(self, id, name, slug, parent_id, path):
+        self.id = id
+        self.name = name
+        self.slug = slug
+        self.parent_id = parent_id
+        self.path = path
+        self.parent = None
+        self.children = []
+
+    def __repr__(self):
+        return self.name
+
+    def link(self, classes=None):
+        return Markup(
+            u"<a class='{2}' href={1}>{0}</a>".format(
+                self.name,
+                url_for("main.category", slug=self.slug),
+                classes or ""
+            )
+        )
+
+    def lineage(self):
+        """
+        From the root category down to this one.
+        """
+        node = self
+        lineage = [node]
+        while node.parent is not None:
+            node = node.parent
+            lineage.insert(0, node)
+        return lineage
+
+    def tree(self, linked=True):
+        if linked:
+            output = " > ".join([e.link() for e in self.lineage()])
+        else:
+            output = " > ".join([e.name for e in self.lineage()])
+        return Markup(output)
+
+
+class CategoryTree(object):
+    """
+    Per-process copy of the whole category forest, built in one query
+    and shared across requests. It is versioned by the row count and
+    latest modification of the categories: each request checks that
+    stamp once, so changes committed by other processes show up on
+    their next request. Changes committed in this process drop the
+    copy right away.
+    """
+    def __init__(self, app=None):
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['category_tree'] = None
+
+    @staticmethod
+    def _stamp():
+        from . import db
+        from .models.content import Category
+        return tuple(db.session.query(func.count(Category.id),
+                                      func.max(Category.modified)).one())
+
+    def _build(self):
+        from .models.content import Category
+        rows = Category.query.with_entities(Category.id,
+                                            Category.name,
+                                            Category.slug,
+                                            Category.parent_id,
+                                            Category.path,
+                                            Category.modified)\
+                             .order_by(Category.name)\
+                             .all()
+        nodes = dict((row.id, CategoryNode(*row[:5])) for row in rows)
+        roots = []
+        for node in sorted(nodes.values(), key=lambda n: n.name):
+            if node.parent_id in nodes:
+                node.parent = nodes[node.parent_id]
+                node.parent.children.append(node)
+            else:
+                roots.append(node)
+        stamp = (len(rows), max(row.modified for row in rows) if rows else None)
+        return { 'stamp': stamp, 'nodes': nodes, 'roots': roots }
+
+    @property
+    def _tree(self):
+        tree = current_app.extensions.get('category_tree')
+        if tree is not None and not g.get('category_tree_checked'):
+            g.category_tree_checked = True
+            if self._stamp() != tree['stamp']:
+                self.invalidate()
+                tree = None
+        if tree is None:
+            with self._lock:
+                tree = current_app.extensions.get('category_tree')
+                if tree is None:
+                    tree = self._build()
+                    current_app.extensions['category_tree'] = tree
+            g.category_tree_checked = True
+        return tree
+
+    def invalidate(self):
+        current_app.extensions['category_tree'] = None
+
+    def get(self, id):
+        return self._tree['nodes'].get(id)
+
+    def find(self, name):
+        for node in self._tree['nodes'].values():
+            if node.name == name:
+                return node
+
+    @property
+    def roots(self):
+        return self._tree['roots']
+
+    def walk(self):
+        """
+        Every category, depth first and by name.
+        """
+        stack = list(reversed(self.roots))
+        while stack:
+            node = stack.pop()
+            stack.extend(reversed(node.children))
+            yield node
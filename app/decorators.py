@@ -2,6 +2,8 @@
 from functools import wraps
 from flask import current_app, abort, redirect, url_for, flash
 from flask.ext.login import current_user
+from sqlalchemy.exc import IntegrityError
+from . import db
 from .models.users import Permission
 from .models.content import Post
 
@@ -34,6 +36,27 @@ def anonymous_required(f):
     return decorated_function
 
 
+def retry_on_conflict(retries=3):
+    """
+    Use as a decorator for views that commit new or renamed content.
+    Slugs are picked at flush time; if a concurrent writer took one
+    in between (or stored the same upload), roll back and run the view
+    again, which picks anew.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            for attempt in range(retries):
+                try:
+                    return f(*args, **kwargs)
+                except IntegrityError:
+                    db.session.rollback()
+                    if attempt == retries - 1:
+                        raise
+        return decorated_function
+    return decorator
+
+
 #   * * *
 
 def permission_required(permission):
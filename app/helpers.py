@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 import re
+import time
+from hashlib import md5
+from datetime import datetime as dt
 from unidecode import unidecode
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from flask import current_app, flash, abort, request, redirect, url_for
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import and_, or_
+from werkzeug.http import is_resource_modified, quote_etag
+from flask import current_app, flash, abort, request, redirect, url_for, \
+                  make_response, session, g
 from flask.ext.login import current_user
+from .cache import LRUCache
 
 
 def urlize(string):
@@ -33,6 +41,111 @@ def load_token(serializer, token):
         return None
 
 
+CURSOR_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def dump_cursor(created, id):
+    """
+    Opaque (and signed) url-safe cursor for a (created, id) key.
+    """
+    s = URLSafeSerializer(current_app.config['SECRET_KEY'], salt='cursor')
+    return s.dumps([created.strftime(CURSOR_FORMAT), id])
+
+
+def load_cursor(cursor):
+    """
+    Inverse of dump_cursor. Abort with 404 if the cursor is not valid.
+    """
+    s = URLSafeSerializer(current_app.config['SECRET_KEY'], salt='cursor')
+    try:
+        created, id = s.loads(cursor)
+        return dt.strptime(created, CURSOR_FORMAT), int(id)
+    except (BadSignature, TypeError, ValueError):
+        abort(404)
+
+
+class KeysetPagination(object):
+    """
+    Cursor-based counterpart of Flask-SQLAlchemy's Pagination.
+    Items are fetched after (or before) a (created, id) key with
+    an indexed range condition instead of OFFSET, and no COUNT
+    is issued, so page N costs the same as page 1.
+
+    keys should be the (created, id) columns of the query entity.
+    """
+    keyset = True
+
+    def __init__(self, query, keys, per_page,
+                 after=None, before=None, descending=True):
+        self.keys = keys
+        self.per_page = per_page
+        forward = before is None
+        cursor = after if forward else before
+        # moving forward over a descending list means going down
+        down = forward == descending
+        if cursor is not None:
+            query = query.filter(self._beyond(load_cursor(cursor), down))
+        order = [k.desc() if down else k.asc() for k in keys]
+        items = query.order_by(*order).limit(per_page + 1).all()
+        more = len(items) > per_page
+        self.items = items[:per_page]
+        if forward:
+            self.has_prev = cursor is not None
+            self.has_next = more
+        else:
+            self.items.reverse()
+            self.has_prev = more
+            self.has_next = True
+
+    def _beyond(self, values, down):
+        created, id = self.keys
+        value_created, value_id = values
+        if down:
+            return or_(created < value_created,
+                       and_(created == value_created, id < value_id))
+        return or_(created > value_created,
+                   and_(created == value_created, id > value_id))
+
+    def _cursor(self, item):
+        return dump_cursor(*[getattr(item, k.key) for k in self.keys])
+
+    @property
+    def prev_cursor(self):
+        if self.has_prev and self.items:
+            return self._cursor(self.items[0])
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.items:
+            return self._cursor(self.items[-1])
+
+
+_gravatar_urls = LRUCache(1000)
+
+def gravatar_url(hash, size=64, default="mm", rating="g", secure=False):
+    """
+    Gravatar URL for an email's md5 hash, memoized per
+    (hash, size, default, rating, scheme).
+    """
+    key = (hash, size, default, rating, secure)
+    url = _gravatar_urls.get(key)
+    if url is None:
+        url = "{url}/{hash}?s={size}&d={default}&r={rating}".format(
+            url = "https://secure.gravatar.com/avatar" if secure \
+                  else "http://www.gravatar.com/avatar",
+            hash = hash,
+            size = size,
+            default = default,
+            rating = rating
+        )
+        _gravatar_urls.set(key, url)
+    return url
+
+
+def avatar_hash(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
 def invalid_token(message=u"Invalid or expired token"):
     flash(message)
     abort(404)
@@ -45,6 +158,39 @@ def get_or_404(model, criterion):
     return obj
 
 
+def not_modified(*state):
+    """
+    Compute the HTTP validators of the page about to be rendered
+    from a cheap summary (state) of what it shows: the ETag hashes it,
+    Last-Modified is its latest datetime. Return a 304 response if the
+    client's copy is still good; None means: render the page,
+    and pass the result through add_validators().
+    """
+    if '_flashes' in session:
+        return None
+    dates = [value for value in state if isinstance(value, dt)]
+    last_modified = max(dates) if dates else None
+    # pages embed CSRF tokens: let them be revalidated
+    # well before the tokens expire
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    epoch = int(time.time() // (limit / 2)) if limit else 0
+    state = (current_user.get_id(), epoch) + state
+    etag = quote_etag(md5(repr(state)).hexdigest(), weak=True)
+    g.validators = (etag, last_modified)
+    if not is_resource_modified(request.environ, etag, last_modified=last_modified):
+        return add_validators(current_app.response_class(status=304))
+
+
+def add_validators(response):
+    response = make_response(response)
+    validators = getattr(g, 'validators', None)
+    if validators is not None:
+        response.headers['ETag'], response.last_modified = validators
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+    return response
+
+
 def redirect_url(): # from flask site
     return request.args.get('next') or \
            request.referrer or \
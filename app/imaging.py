@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import os
+from hashlib import sha256
+try:
+    from PIL import Image as PILImage
+except ImportError: # Pillow is optional: without it, uploads are served as they are
+    PILImage = None
+
+
+# EXIF orientation -> the transpositions that undo it
+ORIENTATION_TAG = 274
+TRANSPOSE = {
+    2: ["FLIP_LEFT_RIGHT"],
+    3: ["ROTATE_180"],
+    4: ["FLIP_TOP_BOTTOM"],
+    5: ["ROTATE_90", "FLIP_TOP_BOTTOM"],
+    6: ["ROTATE_270"],
+    7: ["ROTATE_270", "FLIP_TOP_BOTTOM"],
+    8: ["ROTATE_90"],
+}
+OPTIMIZED_FORMATS = ('JPEG', 'PNG')
+
+
+def variant_filename(filename, width):
+    """
+    photo.jpg, 480 -> photo-480w.jpg
+    """
+    root, ext = os.path.splitext(filename)
+    return "{0}-{1}w{2}".format(root, width, ext)
+
+
+def webp_filename(filename):
+    """
+    photo.jpg -> photo.jpg.webp
+    """
+    return filename + ".webp"
+
+
+def file_digest(path):
+    """
+    sha256 of a file's bytes, as hex.
+    """
+    digest = sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _open(path):
+    if PILImage is None:
+        return None
+    try:
+        image = PILImage.open(path)
+        image.load()
+    except (IOError, OSError):
+        return None
+    return image
+
+
+def _upright(image):
+    """
+    Apply the EXIF orientation to the pixels, since the metadata
+    saying how to turn them is about to go.
+    """
+    try:
+        exif = image._getexif() or {}
+    except (AttributeError, IndexError, KeyError, SyntaxError, IOError):
+        exif = {}
+    format = image.format
+    for method in TRANSPOSE.get(exif.get(ORIENTATION_TAG), []):
+        image = image.transpose(getattr(PILImage, method))
+    image.format = format
+    return image
+
+
+def _save(image, path, format, quality=85, qtables=None):
+    """
+    Save without metadata: nothing is carried over unless asked for.
+    JPEGs are progressive, at the given quality or, with qtables,
+    at the quality of the JPEG those came from.
+    """
+    if format == 'JPEG':
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        options = { 'qtables': qtables } if qtables else { 'quality': quality }
+        image.save(path, format, optimize=True, progressive=True, **options)
+    elif format == 'PNG':
+        image.save(path, format, optimize=True)
+    else:
+        image.save(path, format)
+
+
+def _optimized(image):
+    """
+    Whether image is a JPEG this module already wrote: progressive and
+    with no metadata segment (APP1 and up, comments) but JFIF's APP0.
+    Re-encoding it would only lose quality.
+    """
+    return image.format == 'JPEG' and \
+           ('progressive' in image.info or 'progression' in image.info) and \
+           all(marker == 'APP0' for marker, content in getattr(image, 'applist', []))
+
+
+def optimize(path, quality=85, webp=False):
+    """
+    Re-encode the JPEG or PNG at path in place, stripped of its metadata
+    (EXIF, GPS, thumbnails...); with webp, write a WebP copy next to it
+    too. When a JPEG doesn't get smaller at the given quality, it is
+    re-encoded at its own quality instead, so the metadata goes anyway.
+    JPEGs already saved by this function aren't touched again (every
+    pass would lose quality). Returns the sizes before and after,
+    or None if Pillow is missing or the file can't be read.
+    """
+    image = _open(path)
+    if image is None or image.format not in OPTIMIZED_FORMATS:
+        return None
+    before = after = os.path.getsize(path)
+    if not _optimized(image):
+        qtables = getattr(image, 'quantization', None)
+        image = _upright(image)
+        tmp = path + ".tmp"
+        _save(image, tmp, image.format, quality)
+        if image.format == 'JPEG' and qtables and os.path.getsize(tmp) >= before:
+            _save(image, tmp, image.format, qtables=qtables)
+        after = os.path.getsize(tmp)
+        os.rename(tmp, path) # atomic
+    if webp:
+        save_webp(path, quality)
+    return before, after
+
+
+def save_webp(path, quality=85):
+    """
+    Write a WebP copy of the image at path next to it.
+    """
+    image = _open(path)
+    if image is not None:
+        image.save(webp_filename(path), 'WEBP', quality=quality)
+
+
+def make_variants(path, widths, quality=85):
+    """
+    Write a downsized copy of the image at path, next to it, for each
+    of the widths narrower than the original. Returns the original
+    width and the list of widths written, or None if Pillow is missing
+    or the file can't be read.
+    """
+    original = _open(path)
+    if original is None:
+        return None
+    original = _upright(original)
+    original_width, original_height = original.size
+    made = []
+    for width in sorted(set(widths)):
+        if width >= original_width:
+            break
+        height = max(1, int(round(original_height * float(width) / original_width)))
+        variant = original.resize((width, height), PILImage.ANTIALIAS)
+        _save(variant, variant_filename(path, width), original.format, quality)
+        made.append(width)
+    return original_width, made
@@ -1,16 +1,23 @@
 # -*- coding: utf-8 -*-
-import re
+import os
+import tempfile
+from hashlib import sha256
+from collections import defaultdict
 from datetime import datetime as dt
-from bleach import linkify, clean
-from markdown import markdown
-from hashlib import md5
-from flask import url_for, render_template, Markup, request
+from flask import current_app, url_for, render_template, Markup, request
 from flask.ext.login import current_user
+from flask.ext.sqlalchemy import SignallingSession
+from flask.ext.uploads import UploadNotAllowed, extension
 from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.attributes import get_history, set_committed_value, instance_state
 from . import BaseModel
 from .users import Permission, Role, User
-from .. import db, images
-from ..helpers import urlize
+from .. import db, images, page_cache, category_tree, tasks, render_cache
+from ..helpers import urlize, KeysetPagination, avatar_hash, gravatar_url
+from ..render import RENDER_VERSION, photo_filenames, render_row
+from .. import imaging
 
 
 # MIXINS
@@ -40,58 +47,221 @@ class NameMixin(object):
     @classmethod
     def on_changed_name(cls, target, value, oldvalue, initiator):
         if value != oldvalue:
-            base_slug = urlize(value)
-            slug = base_slug # one more line than needed
-            i = 1
-            while True:
-                with db.session.no_autoflush: # avoids IntegrityError!
-                    if cls.query.filter_by(slug=slug).first() is None:
-                        target.slug = slug
-                        break
-                    i = i + 1
-                    slug = "{0}-{1}".format(base_slug, i)
+            target._slug_base = urlize(value) # see on_before_flush
+
+    @classmethod
+    def allocate_slugs(cls, names, current=None):
+        """
+        Free slugs for a list of names, with a single prefix query:
+        the urlized name if free, else name-2, name-3...
+        current (same length) holds slugs that may be kept, as when
+        renaming. Objects get theirs on flush; use this for imports.
+        """
+        bases = [urlize(name) for name in names]
+        return cls._free_slugs(bases, current)
+
+    @classmethod
+    def _free_slugs(cls, bases, current=None):
+        escape = lambda s: s.replace("\\", "\\\\")\
+                            .replace("%", "\\%")\
+                            .replace("_", "\\_")
+        criteria = [(cls.slug == base) |
+                    cls.slug.like(escape(base) + "-%", escape="\\")
+                    for base in set(bases)]
+        taken = set()
+        if criteria:
+            with db.session.no_autoflush:
+                taken.update(slug for (slug,) in db.session.query(cls.slug)
+                                                            .filter(db.or_(*criteria)))
+        slugs = []
+        for base, own in zip(bases, current or [None] * len(bases)):
+            slug, i = base, 1
+            while slug in taken and slug != own:
+                i = i + 1
+                slug = "{0}-{1}".format(base, i)
+            taken.add(slug)
+            slugs.append(slug)
+        return slugs
+
+    @staticmethod
+    def on_before_flush(session, flush_context, instances):
+        """
+        Give every renamed object its slug, in the order they were
+        added to the session: one query per class.
+        """
+        pending = defaultdict(list)
+        new = sorted(session.new, key=lambda obj: instance_state(obj).insert_order)
+        for obj in new + list(session.dirty):
+            if isinstance(obj, NameMixin) and \
+               obj.__dict__.get("_slug_base") is not None:
+                pending[type(obj)].append(obj)
+        for cls, objs in pending.items():
+            slugs = cls._free_slugs([obj._slug_base for obj in objs],
+                                    [obj.slug for obj in objs])
+            for obj, slug in zip(objs, slugs):
+                obj.slug = slug
+                del obj._slug_base
+
+
+class PathMixin(object):
+    """
+    Materialized path for self-referential hierarchies: the ids from
+    the root down to the row itself, as in "1/4/9/". Kept up to date
+    by mapper events, so ancestors and descendants are one query away.
+    Classes using it need a parent_id column and a parent relationship.
+    Set _path_digits to zero-pad ids, so that ordering by path walks
+    the tree depth first, siblings in id order.
+    """
+    path = db.Column(db.String(255), index=True)
+    _path_digits = None
+
+    @classmethod
+    def _segment(cls, id):
+        return "{}/".format(str(id).zfill(cls._path_digits or 0))
+
+    @property
+    def ancestor_ids(self):
+        return [int(i) for i in (self.path or "").split("/")[:-2]]
+
+    @classmethod
+    def _path_of(cls, connection, id):
+        table = cls.__table__
+        return connection.scalar(db.select([table.c.path])
+                                   .where(table.c.id == id)) or ""
+
+    @classmethod
+    def on_after_insert(cls, mapper, connection, target):
+        # parents are flushed before their children
+        path = (cls._path_of(connection, target.parent_id)
+                if target.parent_id is not None else "") + cls._segment(target.id)
+        connection.execute(cls.__table__.update()
+                                        .where(cls.__table__.c.id == target.id)
+                                        .values(path=path))
+        set_committed_value(target, "path", path)
+
+    @classmethod
+    def on_after_update(cls, mapper, connection, target):
+        if not get_history(target, "parent_id").has_changes():
+            return
+        table = cls.__table__
+        old_path = cls._path_of(connection, target.id)
+        path = (cls._path_of(connection, target.parent_id)
+                if target.parent_id is not None else "") + cls._segment(target.id)
+        # the whole subtree moves along
+        connection.execute(table.update()
+                                .where(table.c.path.like(old_path + "%"))
+                                .values(path = db.literal(path) +
+                                               db.func.substr(table.c.path,
+                                                              len(old_path) + 1)))
+        for obj in object_session(target).identity_map.values():
+            if isinstance(obj, cls) and (obj.path or "").startswith(old_path):
+                set_committed_value(obj, "path", path + obj.path[len(old_path):])
 
 
 class BodyMixin(object):
     body_md = db.Column(db.Text)
     body_html = db.Column(db.Text)
+    render_version = db.Column(db.Integer) # of body_html; None while pending
+
+    def _photos(self):
+        """
+        HTML for the photos the body may reference, by filename.
+        """
+        return {}
+
+    def _attach_photos(self, body_md):
+        pass
+
+    def html(self):
+        if self.render_version == RENDER_VERSION and self.body_html is not None:
+            return Markup(self.body_html)
+        return Markup(render_cache.render(self.body_md or u"", self._photos()))
 
     @classmethod
     def on_changed_body(cls, target, value, oldvalue, initiator):
-        tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i',
-                'img', 'li', 'ol', 'pre', 'strong', 'ul', 'h1', 'h2', 'h3', 'p']
-        attributes = ['alt', 'class', 'id', 'height', 'href', 'rel',
-                      'src', 'title', 'width']
-        md = markdown(value, output_format='html')
-        if cls.__name__ == "Post":
-            photo_pattern = re.compile(r"(!\([^\s]+\.(?:jpe?g|png)\))")
-            photos = photo_pattern.findall(value)
-            for p in photos:
-                with db.session.no_autoflush: # avoids IntegrityError!
-                    photo = Image.query.filter_by(filename=p[2:-1]).first()
-                if photo is not None:
-                    md = md.replace(p, photo.img(width="480", linked=True, with_caption=True))
-                    if not photo in target.images:
-                        target.images.append(photo)
-
-        target.body_html = linkify(clean(md,
-                                         tags = tags,
-                                         attributes = attributes,
-                                         strip = True))
+        if value == oldvalue and target.render_version == RENDER_VERSION:
+            return
+        target._attach_photos(value or u"")
+        if current_app.config['RENDER_ASYNC']:
+            target.render_version = None # see on_commit_render
+        else:
+            target.body_html = render_cache.render(value or u"", target._photos())
+            target.render_version = RENDER_VERSION
+
+    @classmethod
+    def render_stored(cls, id):
+        """
+        Background task: render a stored body and save the result,
+        unless the body was edited again in the meantime.
+        """
+        obj = cls.query.get(id)
+        if obj is None or obj.render_version == RENDER_VERSION:
+            return
+        body = obj.body_md
+        html = render_cache.render(body or u"", obj._photos())
+        table = cls.__table__
+        db.session.execute(table.update()
+                                .where((table.c.id == id) & (table.c.body_md == body))
+                                .values(body_html = html,
+                                        render_version = RENDER_VERSION,
+                                        modified = table.c.modified)) # untouched
+        db.session.commit()
+
+    @classmethod
+    def _photos_by_id(cls, ids):
+        return {}
+
+    @classmethod
+    def rerender(cls, map=map, since=None, after=0, batch=500, stale=False):
+        """
+        Render stored bodies again, in batches of rows ordered by id
+        (starting after the given one), with map (a process pool's
+        imap, for instance). Every batch is saved with one executemany
+        UPDATE and committed, leaving out rows edited in the meantime
+        (as render_stored() does); yields its last id and row count.
+        """
+        table = cls.__table__
+        update = table.update()\
+                      .where((table.c.id == db.bindparam("_id")) &
+                             (db.func.coalesce(table.c.body_md, u"") == db.bindparam("_md")))\
+                      .values(body_html = db.bindparam("_html"),
+                              render_version = RENDER_VERSION,
+                              modified = table.c.modified) # untouched
+        while True:
+            query = db.session.query(cls.id, cls.body_md).filter(cls.id > after)
+            if since is not None:
+                query = query.filter(cls.modified >= since)
+            if stale:
+                query = query.filter((cls.render_version == None) |
+                                     (cls.render_version != RENDER_VERSION))
+            rows = query.order_by(cls.id).limit(batch).all()
+            if not rows:
+                return
+            photos = cls._photos_by_id([id for id, body in rows])
+            jobs = [(id, body or u"", photos.get(id, {})) for id, body in rows]
+            bodies = dict((id, body) for id, body, photos in jobs)
+            db.session.execute(update, [{ "_id": id, "_md": bodies[id], "_html": html }
+                                        for id, html in map(render_row, jobs)])
+            db.session.commit()
+            after = rows[-1].id
+            yield after, len(rows)
 
 
 # MANY_TO_MANY
 ###########################################################
+# (post_id, x_id) primary keys, plus (x_id, post_id) indexes for the reverse side
 post_tag = db.Table(
     "post_tag",
-    db.Column("post_id", db.Integer, db.ForeignKey("post.id")),
-    db.Column("tag_id", db.Integer, db.ForeignKey("tag.id"))
+    db.Column("post_id", db.Integer, db.ForeignKey("post.id"), primary_key=True),
+    db.Column("tag_id", db.Integer, db.ForeignKey("tag.id"), primary_key=True),
+    db.Index("ix_post_tag_tag_id_post_id", "tag_id", "post_id")
 )
 
 post_image = db.Table(
     "post_image",
-    db.Column("post_id", db.Integer, db.ForeignKey("post.id")),
-    db.Column("image_id", db.Integer, db.ForeignKey("image.id"))
+    db.Column("post_id", db.Integer, db.ForeignKey("post.id"), primary_key=True),
+    db.Column("image_id", db.Integer, db.ForeignKey("image.id"), primary_key=True),
+    db.Index("ix_post_image_image_id_post_id", "image_id", "post_id")
 )
 
 
@@ -112,11 +282,16 @@ class Post(MainContentMixin, NameMixin, BodyMixin, AuthorMixin, MenuItem):
     page = db.Column(db.Boolean, default=False)
     comment_enabled = db.Column(db.Boolean, default=True)
     comment_count = db.Column(db.Integer, default=0)
+    comments_modified = db.Column(db.DateTime) # last change to comment_count
+    # (active history: moving a post by id updates both scopes' PostCounter)
+    author_id = db.column_property(db.Column(db.Integer, db.ForeignKey("user.id")),
+                                   active_history = True)
     # relationship w/ Category
-    category_id = db.Column(db.Integer, db.ForeignKey("category.id"))
+    category_id = db.column_property(db.Column(db.Integer, db.ForeignKey("category.id")),
+                                     active_history = True)
     category = db.relationship("Category",
                                backref = "posts",
-                               foreign_keys = category_id)
+                               foreign_keys = "Post.category_id")
     # relationship w/ Tag
     tags = db.relationship("Tag",
                            secondary = post_tag,
@@ -132,11 +307,63 @@ class Post(MainContentMixin, NameMixin, BodyMixin, AuthorMixin, MenuItem):
     _endpoint = "main.post"
 
     __mapper_args__ = { "polymorphic_identity": "post" }
+    __table_args__ = (
+        # post lists: visible posts, newest first
+        db.Index("ix_post_status_page_created", "status", "page", "created"),
+    )
 
     def change_status(self):
         self.status = not self.status
         return self.status
 
+    @classmethod
+    def reconcile_comment_counts(cls):
+        """
+        Recompute comment_count for every post from one grouped query,
+        writing only the posts that drifted; returns how many did.
+        """
+        counts = dict(db.session.query(Comment.post_id, db.func.count(Comment.id))
+                                .group_by(Comment.post_id))
+        rows = db.session.query(cls.id, cls.comment_count).all()
+        wrong = [{ "_id": id, "_count": counts.get(id, 0) }
+                 for id, count in rows if count != counts.get(id, 0)]
+        if wrong:
+            table = cls.__table__
+            db.session.execute(table.update()
+                                    .where(table.c.id == db.bindparam("_id"))
+                                    .values(comment_count = db.bindparam("_count"),
+                                            comments_modified = dt.utcnow(),
+                                            modified = table.c.modified), # untouched
+                               wrong)
+        db.session.commit()
+        return len(wrong)
+
+    @staticmethod
+    def _photo(image):
+        return unicode(image.img(width="480", linked=True, with_caption=True))
+
+    def _photos(self):
+        return dict((i.filename, self._photo(i)) for i in self.images)
+
+    @classmethod
+    def _photos_by_id(cls, ids):
+        photos = defaultdict(dict)
+        rows = db.session.query(post_image.c.post_id, Image)\
+                         .join(Image, Image.id == post_image.c.image_id)\
+                         .filter(post_image.c.post_id.in_(ids))
+        for post_id, image in rows:
+            photos[post_id][image.filename] = cls._photo(image)
+        return photos
+
+    def _attach_photos(self, body_md):
+        filenames = set(photo_filenames(body_md))
+        if not filenames:
+            return
+        with db.session.no_autoflush: # avoids IntegrityError!
+            photos = Image.query.filter(Image.filename.in_(filenames)).all()
+            attached = set(self.images)
+        self.images.extend(photo for photo in photos if photo not in attached)
+
     def status_form(self):
         from ..bp_post.forms import StatusForm
         form = StatusForm(self)
@@ -181,10 +408,10 @@ class Post(MainContentMixin, NameMixin, BodyMixin, AuthorMixin, MenuItem):
 
 
 db.event.listen(Post.name,    "set", Post.on_changed_name)
-db.event.listen(Post.body_md, "set", Post.on_changed_body)
+db.event.listen(Post.body_md, "set", Post.on_changed_body, active_history=True)
 
 
-class Category(MainContentMixin, NameMixin, MenuItem):
+class Category(MainContentMixin, NameMixin, PathMixin, MenuItem):
     id = db.Column(db.Integer, db.ForeignKey("menuitem.id"), primary_key=True)
     excerpt = db.Column(db.Text)
     # hierarchy
@@ -201,12 +428,53 @@ class Category(MainContentMixin, NameMixin, MenuItem):
 
     __mapper_args__ = { "polymorphic_identity": "category" }
 
+    @classmethod
+    def load_ancestors(cls, categories):
+        """
+        Load every ancestor of the given categories in one query
+        and keep them with each category, so that tree() never has
+        to hit the database again.
+        """
+        session = db.session()
+        loaded = dict((c.id, c) for c in categories)
+        missing = set()
+        for c in categories:
+            for id in c.ancestor_ids:
+                if id not in loaded:
+                    obj = session.identity_map.get(identity_key(cls, id))
+                    if obj is not None:
+                        loaded[id] = obj
+                    else:
+                        missing.add(id)
+        if missing:
+            loaded.update((c.id, c)
+                          for c in cls.query.filter(cls.id.in_(missing)))
+        for c in categories:
+            # the identity map only holds weak references
+            c._lineage = (c.path, [loaded[id] for id in c.ancestor_ids] + [c])
+
+    def lineage(self):
+        """
+        From the root category down to this one.
+        """
+        if self.path is None: # not flushed yet
+            parent = self.parent
+            return (parent.lineage() if parent is not None else []) + [self]
+        path, lineage = getattr(self, "_lineage", (None, None))
+        if path != self.path:
+            Category.load_ancestors([self])
+            path, lineage = self._lineage
+        return lineage
+
+    def descendants(self):
+        return Category.query.filter(Category.path.like(self.path + "%"),
+                                     Category.id != self.id)
+
     def tree(self, linked=True):
-        e = self
-        tree_list = [e]
-        while e.parent is not None:
-            e = self.__class__.query.get(e.parent_id)
-            tree_list.insert(0, e)
+        node = category_tree.get(self.id)
+        if node is not None and node.path == self.path:
+            return node.tree(linked=linked)
+        tree_list = self.lineage() # not in the category tree yet
         if linked:
             output = " > ".join([e.link() for e in tree_list])
         else:
@@ -215,6 +483,8 @@ class Category(MainContentMixin, NameMixin, MenuItem):
 
 
 db.event.listen(Category.name, "set", Category.on_changed_name)
+db.event.listen(Category, "after_insert", Category.on_after_insert)
+db.event.listen(Category, "after_update", Category.on_after_update)
 
 
 class Tag(MainContentMixin, NameMixin, MenuItem):
@@ -244,6 +514,11 @@ class Image(MainContentMixin, BaseModel):
     filename = db.Column(db.String(128), index=True, unique=True, nullable=False)
     alternative = db.Column(db.String(128))
     caption = db.Column(db.Text)
+    digest = db.Column(db.String(64), index=True, unique=True) # sha256 of the stored file
+    upload_digest = db.Column(db.String(64), index=True, unique=True) # ... of the upload
+    # filled in the background, see process_upload()
+    width = db.Column(db.Integer)
+    variant_widths = db.Column(db.String(64)) # "120,480,960"
     # relationship w/ Category
     category_id = db.Column(db.Integer, db.ForeignKey("category.id"))
     category = db.relationship("Category",
@@ -258,14 +533,164 @@ class Image(MainContentMixin, BaseModel):
         return self.alternative or self.filename
 
     def url(self):
-        return images.url(self.filename)
+        return self._url(self.filename)
+
+    @staticmethod
+    def _url(filename):
+        """
+        images.url() without its url_for(), which needs a request (or a
+        SERVER_NAME) when no base URL is configured: bodies are rendered
+        in the background too. Relative to the upload set's base URL,
+        or to the route Flask-Uploads serves the uploads from.
+        """
+        base = images.config.base_url
+        if base is not None:
+            return base + filename
+        return current_app.url_map.bind("").build(
+            "_uploads.uploaded_file", { "setname": images.name, "filename": filename })
+
+    @classmethod
+    def from_upload(cls, storage, **kwargs):
+        """
+        The Image for an uploaded file (a FileStorage), stored once as
+        images/ab/cd/abcd...ef.jpg, after the sha256 of the uploaded
+        bytes (upload_digest). The same file uploaded again resolves to
+        its Image from that hash alone, before any decoding, and gives
+        it the alternative text and caption passed, if any. New uploads
+        are optimized (IMAGE_OPTIMIZE) before they are stored; digest
+        is the sha256 of the stored bytes, so different uploads that
+        optimize to the same file are stored once too.
+        """
+        ext = extension(storage.filename).lower()
+        if not images.extension_allowed(ext):
+            raise UploadNotAllowed()
+        root = images.config.destination
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        storage.stream.seek(0)
+        upload_digest = sha256()
+        fd, tmp = tempfile.mkstemp(suffix="." + ext, dir=root)
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: storage.stream.read(64 * 1024), b""):
+                upload_digest.update(chunk)
+                f.write(chunk)
+        upload_digest = upload_digest.hexdigest()
+        try:
+            image = cls.query.filter_by(upload_digest=upload_digest).first()
+            if image is None:
+                config = current_app.config
+                if config['IMAGE_OPTIMIZE']:
+                    sizes = imaging.optimize(tmp, config['IMAGE_QUALITY'])
+                    if sizes is not None:
+                        current_app.logger.info(u"{0}: {1} bytes saved".format(
+                            storage.filename, sizes[0] - sizes[1]))
+                digest = imaging.file_digest(tmp)
+                image = cls.query.filter_by(digest=digest).first()
+            if image is not None:
+                for key, value in kwargs.items():
+                    if value:
+                        setattr(image, key, value)
+                return image
+            filename = "{0}/{1}/{2}.{3}".format(upload_digest[:2], upload_digest[2:4],
+                                                upload_digest, ext)
+            path = images.path(filename)
+            if not os.path.exists(path):
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                os.rename(tmp, path) # atomic
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return cls(filename=filename, digest=digest, upload_digest=upload_digest, **kwargs)
+
+    @classmethod
+    def refresh_digests(cls, paths):
+        """
+        Digests of the images stored at paths (rewritten in place, by
+        'manage.py optimize' for instance) computed again; of several
+        identical files, only one image keeps the digest. Filenames
+        stay: they follow the upload, and bodies refer to them.
+        Returns how many changed.
+        """
+        root = images.config.destination
+        filenames = dict((os.path.relpath(path, root).replace(os.sep, "/"), path)
+                         for path in paths)
+        changed = 0
+        for image in cls.query.filter(cls.filename.in_(filenames.keys())):
+            digest = imaging.file_digest(filenames[image.filename])
+            if digest != image.digest:
+                if cls.query.filter_by(digest=digest).first() is not None:
+                    digest = None
+                image.digest = digest
+                db.session.flush()
+                changed += 1
+        db.session.commit()
+        return changed
+
+    def variants(self):
+        """
+        (url, width) of every stored size, narrowest first,
+        ending with the original upload.
+        """
+        widths = [int(w) for w in (self.variant_widths or "").split(",") if w]
+        return [(self._url(imaging.variant_filename(self.filename, w)), w) for w in widths] \
+               + [(self.url(), self.width)]
+
+    @classmethod
+    def process_upload(cls, id):
+        """
+        Background task: write the WebP copy (IMAGE_WEBP) and the resized
+        copies (IMAGE_VARIANT_WIDTHS) of an upload, and record the latter.
+        The upload itself was optimized by from_upload().
+        """
+        image = cls.query.get(id)
+        if image is None:
+            return
+        config = current_app.config
+        path = images.path(image.filename)
+        if config['IMAGE_WEBP']:
+            imaging.save_webp(path, config['IMAGE_QUALITY'])
+        made = imaging.make_variants(path, config['IMAGE_VARIANT_WIDTHS'],
+                                     config['IMAGE_QUALITY'])
+        if made is None:
+            return
+        width, widths = made
+        table = cls.__table__
+        db.session.execute(table.update()
+                                .where(table.c.id == id)
+                                .values(width = width,
+                                        variant_widths = ",".join(str(w) for w in widths),
+                                        modified = table.c.modified)) # untouched
+        # bodies showing it were rendered without its variants
+        post_ids = [post_id for (post_id,) in
+                    db.session.query(post_image.c.post_id)
+                              .filter(post_image.c.image_id == id)]
+        if post_ids:
+            posts = Post.__table__
+            db.session.execute(posts.update() # bumps modified: new validators
+                                    .where(posts.c.id.in_(post_ids))
+                                    .values(render_version = None))
+        db.session.commit()
+        page_cache.invalidate(*["post:{}".format(post_id) for post_id in post_ids])
+        for post_id in post_ids:
+            tasks.enqueue(Post.render_stored, post_id)
 
     def img(self, width=None, linked=False, with_caption=False):
+        variants = self.variants()
+        src = self.url()
         width_attr = ""
         if width is not None:
             width_attr = ' width="{}"'.format(width)
+            # the narrowest size that fills the given width
+            src = next((url for url, w in variants if w is not None and w >= int(width)),
+                       src)
+        if len(variants) > 1:
+            width_attr += ' srcset="{0}" sizes="{1}"'.format(
+                ", ".join("{0} {1}w".format(url, w) for url, w in variants),
+                "{}px".format(width) if width is not None else "100vw"
+            )
         img_tag = '<img src="{src}" alt="{alt}"{width_attr} class="img-responsive">'.format(
-            src = self.url(),
+            src = src,
             alt = self.alternative,
             width_attr = width_attr
         )
@@ -289,46 +714,443 @@ class Image(MainContentMixin, BaseModel):
         return Markup(img_tag)
 
 
-class Comment(MainContentMixin, BodyMixin, AuthorMixin, BaseModel):
+class Comment(MainContentMixin, BodyMixin, AuthorMixin, PathMixin, BaseModel):
     author_email = db.Column(db.String(128))
     author_name = db.Column(db.String(128))
     author_url = db.Column(db.String(128))
+    avatar_hash = db.Column(db.String(32)) # of author_email
     # relationship w/ Post
-    post_id = db.Column(db.Integer, db.ForeignKey("post.id"))
+    # (active history: moving a comment updates both posts' comment_count)
+    post_id = db.column_property(db.Column(db.Integer, db.ForeignKey("post.id"), index=True),
+                                 active_history = True)
     post = db.relationship("Post",
                            backref = "comments",
-                           foreign_keys = post_id)
+                           foreign_keys = "Comment.post_id")
     # hierarchy
     parent_id = db.Column(db.Integer, db.ForeignKey("comment.id"))
     children = db.relationship("Comment",
                                backref = db.backref("parent", remote_side='Comment.id'),
                                foreign_keys = parent_id)
+    _path_digits = 10
+    replies = () # filled in by thread()
 
     def guest(self):
         return self.author is None
 
     def has_parent(self):
-        return self.parent is not None
+        return self.parent_id is not None
 
     def __call__(self):
-        return Markup(render_template('_comment.html',comment = self))
+        return Markup(render_template('_comment.html', comments=[self]))
+
+    @classmethod
+    def thread(cls, post, after=None, per_page=None):
+        """
+        A page (COMMENTS_PER_PAGE) of the top-level comments of a post,
+        oldest first, as a KeysetPagination; their replies, in path order,
+        hang from .replies. Two queries, whatever the page size.
+        """
+        query = cls.query.options(db.joinedload("author"))\
+                         .filter(cls.post_id == post.id)
+        page = KeysetPagination(query.filter(cls.parent_id == None),
+                                (cls.created, cls.id),
+                                per_page or current_app.config['COMMENTS_PER_PAGE'],
+                                after = after,
+                                descending = False)
+        by_id = {}
+        for c in page.items:
+            c.replies = []
+            by_id[c.id] = c
+        if by_id:
+            # the first path segment is the thread's top-level comment
+            root = db.func.substr(cls.path, 1, cls._path_digits + 1)
+            replies = query.filter(cls.parent_id != None)\
+                           .filter(root.in_([c.path for c in page.items]))\
+                           .order_by(cls.path)\
+                           .all()
+            for c in replies:
+                c.replies = []
+                by_id[c.id] = c
+                by_id[c.parent_id].replies.append(c)
+        return page
+
+    @staticmethod
+    def parent_for(comment):
+        """
+        Where a reply to comment goes: answers nested deeper than
+        COMMENT_MAX_DEPTH hang from the deepest allowed ancestor.
+        """
+        depth = current_app.config['COMMENT_MAX_DEPTH']
+        lineage = (comment.ancestor_ids + [comment.id])[:max(depth - 1, 0)]
+        if not lineage:
+            return None
+        return comment if lineage[-1] == comment.id else Comment.query.get(lineage[-1])
 
-    def _set_avatar_hash(self):
-        self.avatar_hash = md5(self.email.lower().encode('utf-8')).hexdigest()
+    @staticmethod
+    def on_changed_email(target, value, oldvalue, initiator):
+        target.avatar_hash = avatar_hash(value) if value else None
 
     def gravatar(self, size=64, default="mm", rating="g"):
         if not self.guest():
             return self.author.gravatar(size=size, default=default, rating=rating)
-        if request.is_secure:
-            url = "https://secure.gravatar.com/avatar"
-        else:
-            url = "http://www.gravatar.com/avatar"
-        return "{url}/{hash}?s={size}&d={default}&r={rating}".format(
-            url = url,
-            hash = md5(self.author_email.lower().encode('utf-8')).hexdigest(),
-            size = size,
-            default = default,
-            rating = rating
-        )
+        return gravatar_url(self.avatar_hash, size, default, rating,
+                            secure = request.is_secure)
+
+db.event.listen(Comment.body_md, "set", Comment.on_changed_body, active_history=True)
+db.event.listen(Comment.author_email, "set", Comment.on_changed_email)
+db.event.listen(Comment, "after_insert", Comment.on_after_insert)
+db.event.listen(Comment, "after_update", Comment.on_after_update)
+
+
+# COMMENT COUNTS
+###########################################################
+def _count_comments(connection, post_id, delta):
+    """
+    Atomic post.comment_count update, in the flush's transaction.
+    post.modified means edited and stays; comments_modified takes
+    the time, for HTTP validators (PostCounter.on_after_flush touches
+    the post's listings).
+    """
+    if post_id is None:
+        return
+    table = Post.__table__
+    count = db.func.coalesce(table.c.comment_count, 0) + delta
+    connection.execute(table.update()
+                            .where(table.c.id == post_id)
+                            .values(comment_count = count,
+                                    comments_modified = dt.utcnow(),
+                                    modified = table.c.modified)) # untouched
+
+
+def on_insert_comment(mapper, connection, target):
+    _count_comments(connection, target.post_id, 1)
+
+
+def on_delete_comment(mapper, connection, target):
+    _count_comments(connection, target.post_id, -1)
+
+
+def on_update_comment(mapper, connection, target):
+    history = get_history(target, "post_id")
+    if history.deleted:
+        _count_comments(connection, history.deleted[0], -1)
+        _count_comments(connection, target.post_id, 1)
+
+
+db.event.listen(Comment, "after_insert", on_insert_comment)
+db.event.listen(Comment, "after_delete", on_delete_comment)
+db.event.listen(Comment, "after_update", on_update_comment)
+
+
+# COUNTERS
+###########################################################
+class PostCounter(BaseModel):
+    """
+    Number of posts (pages excluded) per listing scope:
+    ('index', 0), ('author', id), ('tag', id), ('category', id).
+    Kept up to date from session events, so listings can draw
+    their page numbers without a COUNT(*). modified is touched
+    whenever any post within the scope changes.
+    """
+    scope = db.Column(db.String(16), nullable=False)
+    scope_id = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    published = db.Column(db.Integer, nullable=False, default=0)
+    modified = db.Column(db.DateTime, default=dt.utcnow)
+
+    __table_args__ = (db.UniqueConstraint("scope", "scope_id"),)
+
+    @classmethod
+    def _where(cls, scope, scope_id):
+        # scope_id may also be a list of ids, whose counts add up
+        if isinstance(scope_id, (list, tuple)):
+            return (cls.scope == scope) & cls.scope_id.in_(scope_id)
+        return (cls.scope == scope) & (cls.scope_id == scope_id)
+
+    @classmethod
+    def get(cls, scope, scope_id=0, published=False):
+        column = cls.published if published else cls.total
+        count = db.session.query(db.func.sum(column))\
+                          .filter(cls._where(scope, scope_id))\
+                          .scalar()
+        return count or 0
+
+    @classmethod
+    def state(cls, scope, scope_id=0):
+        """
+        (total, published, modified) of a scope, for HTTP validators.
+        """
+        row = db.session.query(db.func.sum(cls.total),
+                               db.func.sum(cls.published),
+                               db.func.max(cls.modified))\
+                        .filter(cls._where(scope, scope_id))\
+                        .one()
+        return tuple(row)
+
+    @staticmethod
+    def post_scopes(post, when="after"):
+        """
+        (published, scopes) of a post 'before' or 'after' the flush
+        in progress; None if it is a page (and thus not listed).
+        """
+        def values(key):
+            history = get_history(post, key)
+            changed = history.deleted if when == "before" else history.added
+            return [v for v in list(history.unchanged) + list(changed)
+                    if v is not None]
+        def ids(column, relationship):
+            # the foreign key, set directly or synced from the relationship;
+            # the relationship itself when the key isn't known (pending)
+            return values(column) or [obj.id for obj in values(relationship)]
+        if any(values("page")):
+            return None
+        scopes = [("index", 0)]
+        scopes.extend(("author", id) for id in ids("author_id", "author"))
+        scopes.extend(("category", id) for id in ids("category_id", "category"))
+        scopes.extend(("tag", t.id) for t in values("tags"))
+        return any(values("status")), scopes
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Count the posts of every scope again from scratch, with one
+        grouped query per kind of scope, writing only the rows that
+        drifted and dropping those of scopes that are gone; returns
+        how many rows changed.
+        """
+        published = db.func.sum(db.case([(Post.status == True, 1)], else_=0))
+        listed = db.func.coalesce(Post.page, False) == False
+        queries = [
+            ("index", db.session.query(db.literal(0), db.func.count(Post.id), published)),
+            ("author", db.session.query(Post.author_id, db.func.count(Post.id), published)
+                                 .filter(Post.author_id != None)
+                                 .group_by(Post.author_id)),
+            ("category", db.session.query(Post.category_id, db.func.count(Post.id), published)
+                                   .filter(Post.category_id != None)
+                                   .group_by(Post.category_id)),
+            ("tag", db.session.query(post_tag.c.tag_id, db.func.count(Post.id), published)
+                              .select_from(Post)
+                              .join(post_tag, post_tag.c.post_id == Post.id)
+                              .group_by(post_tag.c.tag_id)),
+        ]
+        counts = {}
+        for scope, query in queries:
+            for scope_id, total, count in query.filter(listed):
+                counts[(scope, scope_id)] = (total, count or 0)
+        counts.setdefault(("index", 0), (0, 0))
+        table = cls.__table__
+        now = dt.utcnow()
+        changed = 0
+        rows = db.session.query(cls.scope, cls.scope_id, cls.total, cls.published).all()
+        for scope, scope_id, total, count in rows:
+            where = (table.c.scope == scope) & (table.c.scope_id == scope_id)
+            if (scope, scope_id) not in counts:
+                db.session.execute(table.delete().where(where))
+                changed += 1
+                continue
+            total_now, count_now = counts.pop((scope, scope_id))
+            if (total, count) != (total_now, count_now):
+                db.session.execute(table.update().where(where).values(
+                    total = total_now, published = count_now, modified = now))
+                changed += 1
+        for (scope, scope_id), (total, count) in counts.items():
+            db.session.execute(table.insert().values(scope = scope,
+                                                     scope_id = scope_id,
+                                                     total = total,
+                                                     published = count,
+                                                     modified = now))
+            changed += 1
+        db.session.commit()
+        return changed
+
+    @staticmethod
+    def _commented_posts(session):
+        """
+        Ids of the posts whose comment count the flush changed.
+        """
+        ids = set()
+        for obj in list(session.new) + list(session.deleted):
+            if isinstance(obj, Comment):
+                ids.add(obj.post_id)
+        for obj in session.dirty:
+            if isinstance(obj, Comment):
+                history = get_history(obj, "post_id")
+                if history.deleted:
+                    ids.update(history.deleted)
+                    ids.update(history.added)
+        ids.discard(None)
+        return ids
+
+    @classmethod
+    def on_after_flush(cls, session, flush_context):
+        deltas = defaultdict(lambda: [0, 0])
+        def count(post, when, sign):
+            state = cls.post_scopes(post, when)
+            if state is not None:
+                published, scopes = state
+                for scope in scopes:
+                    deltas[scope][0] += sign
+                    deltas[scope][1] += sign * published
+        for post in session.new:
+            if isinstance(post, Post):
+                count(post, "after", 1)
+        for post in session.deleted:
+            if isinstance(post, Post):
+                count(post, "before", -1)
+        for post in session.dirty:
+            if isinstance(post, Post) and session.is_modified(post):
+                count(post, "before", -1)
+                count(post, "after", 1)
+        # listings show comment counts: touch the scopes of commented posts
+        with session.no_autoflush:
+            for post_id in cls._commented_posts(session):
+                post = session.query(Post).get(post_id)
+                state = cls.post_scopes(post) if post is not None else None
+                if state is not None:
+                    for scope in state[1]:
+                        deltas[scope] # same totals, new modified
+
+        table = cls.__table__
+        connection = session.connection()
+        now = dt.utcnow()
+        # the scopes of deleted authors, categories and tags go with them
+        gone = [(scope, obj.id) for obj in session.deleted
+                                for kind, scope in ((User, "author"),
+                                                    (Category, "category"),
+                                                    (Tag, "tag"))
+                                if isinstance(obj, kind)]
+        for scope in gone:
+            deltas.pop(scope, None)
+        for (scope, scope_id), (total, published) in deltas.items():
+            where = (table.c.scope == scope) & (table.c.scope_id == scope_id)
+            result = connection.execute(
+                table.update().where(where).values(
+                    total = table.c.total + total,
+                    published = table.c.published + published,
+                    modified = now))
+            if result.rowcount == 0:
+                connection.execute(
+                    table.insert().values(scope = scope,
+                                          scope_id = scope_id,
+                                          total = total,
+                                          published = published,
+                                          modified = now))
+        for scope, scope_id in gone:
+            connection.execute(table.delete().where((table.c.scope == scope) &
+                                                    (table.c.scope_id == scope_id)))
+
+
+db.event.listen(SignallingSession, "before_flush", NameMixin.on_before_flush)
+db.event.listen(SignallingSession, "after_flush", PostCounter.on_after_flush)
+
+
+# PAGE CACHE INVALIDATION
+###########################################################
+def _post_pages(post, when):
+    names = set(["post:{}".format(post.id)])
+    state = PostCounter.post_scopes(post, when)
+    if state is not None:
+        names.update("{0}:{1}".format(*scope) for scope in state[1])
+    return names
+
+
+def _changed_pages(obj, when):
+    """
+    Names (see PageCache.depends) of the pages showing obj.
+    """
+    if isinstance(obj, Post):
+        return _post_pages(obj, when)
+    if isinstance(obj, Comment) and obj.post is not None:
+        return _post_pages(obj.post, "after")
+    if isinstance(obj, (Tag, Category)): # asides, on every page
+        return set(["all"])
+    if isinstance(obj, Image):
+        names = set()
+        with db.session.no_autoflush:
+            posts = obj.posts + Post.query.filter_by(main_image_id=obj.id).all()
+        for post in posts:
+            names.update(_post_pages(post, "after"))
+        return names
+    return set()
+
+
+def on_flush_pages(session, flush_context):
+    names = session.info.setdefault("page_cache_invalidate", set())
+    for obj in session.new:
+        names.update(_changed_pages(obj, "after"))
+    for obj in session.deleted:
+        names.update(_changed_pages(obj, "before"))
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            names.update(_changed_pages(obj, "before"))
+            names.update(_changed_pages(obj, "after"))
+
+
+def on_commit_pages(session):
+    # names left by a rollback are just invalidated on the next commit
+    names = session.info.pop("page_cache_invalidate", None)
+    if names:
+        page_cache.invalidate(*names)
+
+
+db.event.listen(SignallingSession, "after_flush", on_flush_pages)
+db.event.listen(SignallingSession, "after_commit", on_commit_pages)
+
+
+# CATEGORY TREE INVALIDATION
+###########################################################
+def on_flush_categories(session, flush_context):
+    for obj in set(session.new) | set(session.deleted):
+        if isinstance(obj, Category):
+            session.info["category_tree_invalidate"] = True
+            return
+    for obj in session.dirty:
+        if isinstance(obj, Category) and \
+           session.is_modified(obj, include_collections=False):
+            session.info["category_tree_invalidate"] = True
+            return
+
+
+def on_commit_categories(session):
+    if session.info.pop("category_tree_invalidate", False):
+        category_tree.invalidate()
+
+
+db.event.listen(SignallingSession, "after_flush", on_flush_categories)
+db.event.listen(SignallingSession, "after_commit", on_commit_categories)
+
+
+# BACKGROUND RENDERING
+###########################################################
+def on_flush_render(session, flush_context):
+    jobs = session.info.setdefault("render_jobs", set())
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, BodyMixin) and obj.render_version is None:
+            jobs.add((type(obj), obj.id))
+
+
+def on_commit_render(session):
+    for cls, id in session.info.pop("render_jobs", ()):
+        tasks.enqueue(cls.render_stored, id)
+
+
+db.event.listen(SignallingSession, "after_flush", on_flush_render)
+db.event.listen(SignallingSession, "after_commit", on_commit_render)
+
+
+# UPLOAD PROCESSING
+###########################################################
+def on_flush_images(session, flush_context):
+    jobs = session.info.setdefault("image_jobs", set())
+    for obj in session.new:
+        if isinstance(obj, Image):
+            jobs.add(obj.id)
+
+
+def on_commit_images(session):
+    for id in session.info.pop("image_jobs", ()):
+        tasks.enqueue(Image.process_upload, id)
+
 
-db.event.listen(Comment.body_md, "set", Comment.on_changed_body)
+db.event.listen(SignallingSession, "after_flush", on_flush_images)
+db.event.listen(SignallingSession, "after_commit", on_commit_images)
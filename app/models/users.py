@@ -1,12 +1,11 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime as dt
-from hashlib import md5
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask import current_app, request
 from flask.ext.login import UserMixin, AnonymousUserMixin, current_user
 from .. import db, login_manager
 from . import BaseModel
-from ..helpers import serialize, load_token
+from ..helpers import serialize, load_token, avatar_hash, gravatar_url
 
 
 class Permission():
@@ -95,20 +94,11 @@ class User(UserMixin, BaseModel):
 
     #avatar
     def _set_avatar_hash(self):
-        self.avatar_hash = md5(self.email.lower().encode('utf-8')).hexdigest()
+        self.avatar_hash = avatar_hash(self.email)
 
     def gravatar(self, size=64, default="mm", rating="g"):
-        if request.is_secure:
-            url = "https://secure.gravatar.com/avatar"
-        else:
-            url = "http://www.gravatar.com/avatar"
-        return "{url}/{hash}?s={size}&d={default}&r={rating}".format(
-            url = url,
-            hash = self.avatar_hash,
-            size = size,
-            default = default,
-            rating = rating
-        )
+        return gravatar_url(self.avatar_hash, size, default, rating,
+                            secure = request.is_secure)
 
     # tokens
     def generate_confirmation_token(self, expiration=3600):
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import re
+from hashlib import sha1
+from bleach import linkify, clean
+from markdown import markdown
+from flask import current_app, has_app_context
+from .cache import LRUCache, FileSystemCache
+
+
+# bump whenever the output below changes, so stored renders get redone
+RENDER_VERSION = 2
+
+TAGS = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i',
+        'img', 'li', 'ol', 'pre', 'strong', 'ul', 'h1', 'h2', 'h3', 'p']
+ATTRIBUTES = ['alt', 'class', 'id', 'height', 'href', 'rel',
+              'sizes', 'src', 'srcset', 'title', 'width']
+
+PHOTO_PATTERN = re.compile(r"(!\([^\s]+\.(?:jpe?g|png)\))")
+
+
+def photo_filenames(body_md):
+    """
+    Filenames referenced as !(filename.jpg) in a Markdown body.
+    """
+    return [p[2:-1] for p in PHOTO_PATTERN.findall(body_md)]
+
+
+def _clean(html):
+    return clean(html, tags=TAGS, attributes=ATTRIBUTES, strip=True)
+
+
+def render(body_md, photos=None):
+    """
+    Markdown to sanitized HTML. photos maps the filenames referenced
+    in the body to their HTML. Needs neither database nor app context.
+    """
+    html = linkify(_clean(markdown(body_md, output_format='html')))
+    if photos:
+        # after linkify, which drops srcset and sizes; photos get cleaned on their own
+        photos = dict((filename, _clean(photo)) for filename, photo in photos.items())
+        html = PHOTO_PATTERN.sub(lambda m: photos.get(m.group(0)[2:-1], m.group(0)),
+                                 html) # a single pass, whatever the photo count
+    return html
+
+
+def render_row(row):
+    """
+    (id, body_md, photos) to (id, html), through the render cache;
+    top-level so that process pools can pickle it.
+    """
+    from . import render_cache
+    id, body_md, photos = row
+    return id, render_cache.render(body_md, photos)
+
+
+class RenderCache(object):
+    """
+    Rendered bodies keyed on a hash of everything that goes into them:
+    the Markdown, the photos, the sanitizer lists and RENDER_VERSION.
+    An in-process LRU tier (RENDER_CACHE_SIZE) sits in front of an
+    optional shared one, set through RENDER_CACHE_TYPE:
+        None (local tier only),
+        'filesystem' (RENDER_CACHE_DIR, up to RENDER_CACHE_THRESHOLD files).
+    """
+    backends = {
+        'filesystem': lambda app: FileSystemCache(app.config['RENDER_CACHE_DIR'],
+                                                  app.config['RENDER_CACHE_THRESHOLD']),
+    }
+
+    def __init__(self, app=None):
+        self.local = LRUCache(500)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RENDER_CACHE_TYPE', None)
+        app.config.setdefault('RENDER_CACHE_SIZE', 500)
+        app.config.setdefault('RENDER_CACHE_DIR', None)
+        app.config.setdefault('RENDER_CACHE_THRESHOLD', 5000)
+        self.local.size = app.config['RENDER_CACHE_SIZE']
+        shared = None
+        if app.config['RENDER_CACHE_TYPE'] is not None:
+            shared = self.backends[app.config['RENDER_CACHE_TYPE']](app)
+        app.extensions['render_cache'] = shared
+
+    @property
+    def shared(self):
+        if has_app_context():
+            return current_app.extensions.get('render_cache')
+
+    @staticmethod
+    def key(body_md, photos=None):
+        return sha1(repr((RENDER_VERSION, TAGS, ATTRIBUTES,
+                          body_md, sorted((photos or {}).items())))).hexdigest()
+
+    def render(self, body_md, photos=None):
+        key = self.key(body_md, photos)
+        html = self.local.get(key)
+        if html is None and self.shared is not None:
+            html = self.shared.get(key)
+            if html is not None:
+                self.local.set(key, html)
+        if html is None:
+            html = render(body_md, photos)
+            self.local.set(key, html)
+            if self.shared is not None:
+                self.shared.set(key, html)
+        return html
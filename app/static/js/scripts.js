@@ -55,6 +55,20 @@ function answerClick(elements) {
   });
 }
 
+// moreComments
+function moreComments(link) {
+  link.click( function(e) {
+    e.preventDefault();
+    $.getJSON(link.attr("href"), function(response) {
+      var comments = $(response.html);
+      link.parent(".more-comments").before(comments);
+      answerClick( comments.find(".answer-button") );
+      if (response.next) { link.attr("href", response.next); }
+      else { link.parent(".more-comments").remove(); }
+    });
+  });
+}
+
 // setAjax
 function setAjax(form, success) {
   form.submit( function(e) {
@@ -137,4 +151,7 @@ $( function() {
 
   // activate answer buttons
   answerClick( $(".answer-button") );
+
+  // load further comment threads on demand
+  moreComments( $(".more-comments > a") );
 })
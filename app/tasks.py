@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import logging
+from Queue import Queue
+from threading import Thread, Lock, ThreadError
+from flask import current_app, g
+
+
+class _ErrorHandler(logging.StreamHandler):
+    """
+    Errors to stderr when the app isn't in debug mode: Flask's own
+    handler only prints in debug mode, so without a handler of their
+    own (see ProductionConfig) background failures would go unseen.
+    """
+    def __init__(self, app):
+        logging.StreamHandler.__init__(self)
+        self.app = app
+        self.setLevel(logging.ERROR)
+        self.setFormatter(logging.Formatter(app.debug_log_format))
+
+    def emit(self, record):
+        if not self.app.debug:
+            logging.StreamHandler.emit(self, record)
+
+
+class TaskQueue(object):
+    """
+    Runs functions in a few background threads (TASK_WORKERS), each
+    one within an app context of the app that queued it, so that slow
+    work never holds a request back. When no thread can be started,
+    functions run in the calling thread instead, once its app context
+    ends (they are queued from after_commit hooks, where the session
+    can't be used yet).
+    """
+    def __init__(self, app=None):
+        self._queue = Queue()
+        self._workers = []
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TASK_WORKERS', 2)
+        if len(app.logger.handlers) <= 1 and not app.testing: # only Flask's debug handler
+            app.logger.addHandler(_ErrorHandler(app))
+        # registered after Flask-SQLAlchemy's: runs before the session goes
+        app.teardown_appcontext(self._run_deferred)
+
+    @staticmethod
+    def _run(f, args, kwargs):
+        try:
+            f(*args, **kwargs)
+        except Exception:
+            current_app.logger.exception(u"Background task {} failed".format(f.__name__))
+
+    def _run_deferred(self, exception=None):
+        while getattr(g, 'deferred_tasks', None):
+            f, args, kwargs = g.deferred_tasks.pop(0)
+            self._run(f, args, kwargs)
+
+    def _work(self):
+        while True:
+            app, f, args, kwargs = self._queue.get()
+            try:
+                with app.app_context():
+                    self._run(f, args, kwargs)
+            except Exception:
+                app.logger.exception(u"Background task {} failed".format(f.__name__))
+            finally:
+                self._queue.task_done()
+
+    def _start(self, count):
+        with self._lock:
+            while len(self._workers) < count:
+                thr = Thread(target=self._work)
+                thr.daemon = True
+                thr.start()
+                self._workers.append(thr)
+
+    def enqueue(self, f, *args, **kwargs):
+        app = current_app._get_current_object()
+        try:
+            self._start(app.config['TASK_WORKERS'])
+        except (ThreadError, RuntimeError):
+            if not self._workers:
+                app.logger.warning(u"No background thread: {} deferred".format(f.__name__))
+                g.deferred_tasks = getattr(g, 'deferred_tasks', []) + [(f, args, kwargs)]
+                return
+        self._queue.put((app, f, args, kwargs))
+
+    def join(self):
+        """
+        Wait until every queued task is done, running the deferred ones.
+        """
+        self._run_deferred()
+        self._queue.join()
@@ -27,11 +27,38 @@ class Config:
 
     SIGNUP_ENABLED = True
     POSTS_PER_PAGE = 10
+    POSTS_KEYSET_PAGINATION = False # ?after= cursors instead of ?page=
+    CATEGORY_LIST_SUBTREE = False # category pages include subcategories (opt-in)
 
     UPLOADS_DEFAULT_DEST = './app/static/uploads'
     UPLOADS_DEFAULT_URL = '/static/uploads/'
+    # with Pillow installed, uploads are re-encoded without metadata
+    # as they are stored; WebP and resized copies are made in the background
+    IMAGE_OPTIMIZE = True
+    IMAGE_QUALITY = 85
+    IMAGE_WEBP = False # also write a .webp copy of each upload
+    IMAGE_VARIANT_WIDTHS = (120, 480, 960)
 
     COMMENT_MAX_DEPTH = 2
+    COMMENTS_PER_PAGE = 20
+
+    RENDER_ASYNC = True # render Markdown bodies in the background
+    TASK_WORKERS = 2
+    # rendered bodies: in-process LRU, plus None or 'filesystem' shared tier
+    RENDER_CACHE_TYPE = os.environ.get('RENDER_CACHE_TYPE')
+    RENDER_CACHE_SIZE = 500
+    RENDER_CACHE_DIR = os.path.join(basedir, 'cache', 'render')
+    RENDER_CACHE_THRESHOLD = 5000 # files
+
+    # anonymous page cache: None, 'lru' or 'filesystem'
+    PAGE_CACHE_TYPE = os.environ.get('PAGE_CACHE_TYPE')
+    PAGE_CACHE_SIZE = 500
+    PAGE_CACHE_DIR = os.path.join(basedir, 'cache', 'page')
+    PAGE_CACHE_THRESHOLD = 5000 # files
+    PAGE_CACHE_TIMEOUT = 300
+
+    TAG_CLOUD_SIZE = 30
+    TAG_CLOUD_TIMEOUT = 300
 
     ORIGIN = datetime(2016, 8, 20, 12, 00, 00, 000000)
 
@@ -53,6 +80,7 @@ class TestingConfig(Config):
     Testing configuration class.
     """
     TESTING = True
+    RENDER_ASYNC = False
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data-test.sqlite')
 
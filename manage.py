@@ -2,7 +2,8 @@
 import os
 from app import create_app, db
 from app.models.users import Permission, Role, User, AnonymousUser
-from app.models.content import MenuItem, Post, Category, Tag, Image, Comment
+from app.models.content import MenuItem, Post, Category, Tag, Image, Comment, \
+                               PostCounter
 from flask.ext.script import Manager, Shell
 from flask.ext.migrate import Migrate, MigrateCommand
 
@@ -24,7 +25,8 @@ def make_shell_context():
         Category = Category,
         Tag = Tag,
         Image = Image,
-        Comment = Comment
+        Comment = Comment,
+        PostCounter = PostCounter
     )
 
 manager.add_command("shell", Shell(make_context=make_shell_context))
@@ -37,6 +39,109 @@ def test():
     tests = unittest.TestLoader().discover('tests')
     unittest.TextTestRunner(verbosity=2).run(tests)
 
+@manager.option('--since', dest='since', default=None,
+                help="Only bodies modified since this date (YYYY-MM-DD).")
+@manager.option('--stale', dest='stale', action='store_true', default=False,
+                help="Only bodies rendered by an older RENDER_VERSION.")
+@manager.option('--batch', dest='batch', type=int, default=500,
+                help="Rows per batch (and per commit).")
+@manager.option('--workers', dest='workers', type=int, default=None,
+                help="Render processes (one per CPU by default).")
+@manager.option('--restart', dest='restart', action='store_true', default=False,
+                help="Ignore the checkpoint left by an interrupted run.")
+def rerender(since=None, stale=False, batch=500, workers=None, restart=False):
+    """Render post and comment bodies again, resuming if interrupted."""
+    import json
+    import time
+    from datetime import datetime
+    from multiprocessing import Pool
+
+    checkpoint = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '.rerender-checkpoint')
+    done = {}
+    if os.path.exists(checkpoint) and not restart:
+        with open(checkpoint) as f:
+            done = json.load(f)
+        print("Resuming after {}".format(done))
+    if since is not None:
+        since = datetime.strptime(since, "%Y-%m-%d")
+
+    pool = Pool(workers)
+    try:
+        for cls in (Post, Comment):
+            start = time.time()
+            total = 0
+            for last_id, count in cls.rerender(map = pool.imap,
+                                               since = since,
+                                               after = done.get(cls.__name__, 0),
+                                               batch = batch,
+                                               stale = stale):
+                total += count
+                done[cls.__name__] = last_id
+                with open(checkpoint, 'w') as f:
+                    json.dump(done, f)
+                elapsed = time.time() - start
+                print("{0}: {1} rows, up to id {2} ({3:.1f} rows/s)".format(
+                      cls.__name__, total, last_id, total / (elapsed or 1)))
+            print("{0}: done, {1} rows in {2:.1f}s".format(
+                  cls.__name__, total, time.time() - start))
+    finally:
+        pool.close()
+        pool.join()
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+@manager.option('--quality', dest='quality', type=int, default=None,
+                help="JPEG/WebP quality (IMAGE_QUALITY by default).")
+@manager.option('--webp', dest='webp', action='store_true', default=False,
+                help="Also write a .webp copy of every image.")
+@manager.option('--workers', dest='workers', type=int, default=None,
+                help="Processes (one per CPU by default).")
+def optimize(quality=None, webp=False, workers=None):
+    """Strip metadata from and re-encode every uploaded image."""
+    from functools import partial
+    from multiprocessing import Pool
+    from app import imaging
+
+    if imaging.PILImage is None:
+        print("Pillow is not installed")
+        return
+    root = app.config['UPLOADS_DEFAULT_DEST']
+    paths = [os.path.join(directory, filename)
+             for directory, dirs, filenames in os.walk(root)
+             for filename in filenames
+             if os.path.splitext(filename)[1].lower() in ('.jpg', '.jpeg', '.png')]
+    job = partial(imaging.optimize,
+                  quality = quality or app.config['IMAGE_QUALITY'],
+                  webp = webp or app.config['IMAGE_WEBP'])
+    pool = Pool(workers)
+    before = after = 0
+    optimized = []
+    try:
+        for path, sizes in zip(paths, pool.imap(job, paths)):
+            if sizes is not None:
+                before += sizes[0]
+                after += sizes[1]
+                optimized.append(path)
+    finally:
+        pool.close()
+        pool.join()
+    fixed = Image.refresh_digests(optimized)
+    print("{0} images, {1} bytes saved ({2:.1f}%), {3} digests updated".format(
+          len(optimized), before - after, 100.0 * (before - after) / (before or 1), fixed))
+
+@manager.command
+def reconcile():
+    """Recompute the comment count of every post."""
+    fixed = Post.reconcile_comment_counts()
+    print("{} post comment counts fixed".format(fixed))
+
+@manager.command
+def recount():
+    """Rebuild the post counts of every listing scope."""
+    fixed = PostCounter.rebuild()
+    print("{} post counters fixed".format(fixed))
+
 @manager.command
 def deploy():
     """Run deployment tasks."""
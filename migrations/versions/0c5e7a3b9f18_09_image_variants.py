@@ -0,0 +1,25 @@
+"""09 Image variants
+
+Revision ID: 0c5e7a3b9f18
+Revises: f7a41c9e2d63
+Create Date: 2026-10-18 22:15:48.307000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0c5e7a3b9f18'
+down_revision = 'f7a41c9e2d63'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('image', sa.Column('width', sa.Integer(), nullable=True))
+    op.add_column('image', sa.Column('variant_widths', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('image') as batch_op:
+        batch_op.drop_column('variant_widths')
+        batch_op.drop_column('width')
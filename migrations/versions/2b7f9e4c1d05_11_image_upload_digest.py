@@ -0,0 +1,27 @@
+"""11 Image upload digest
+
+Revision ID: 2b7f9e4c1d05
+Revises: 9d2f4b6e8a10
+Create Date: 2026-10-19 10:14:52.307000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b7f9e4c1d05'
+down_revision = '9d2f4b6e8a10'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # the bytes of earlier uploads are gone: those images are only found
+    # again by the digest of their stored file
+    op.add_column('image', sa.Column('upload_digest', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_image_upload_digest'), 'image', ['upload_digest'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_image_upload_digest'), table_name='image')
+    with op.batch_alter_table('image') as batch_op:
+        batch_op.drop_column('upload_digest')
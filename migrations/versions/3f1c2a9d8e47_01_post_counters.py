@@ -0,0 +1,52 @@
+"""01 Post counters
+
+Revision ID: 3f1c2a9d8e47
+Revises: 7b306c2efb8e
+Create Date: 2026-10-18 16:05:12.417000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d8e47'
+down_revision = '7b306c2efb8e'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+PUBLISHED = "COALESCE(SUM(CASE WHEN post.status THEN 1 ELSE 0 END), 0)"
+LISTED = "(post.page IS NULL OR NOT post.page)"
+
+
+def upgrade():
+    op.create_table('postcounter',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('scope', sa.String(length=16), nullable=False),
+    sa.Column('scope_id', sa.Integer(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.Column('published', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('scope', 'scope_id')
+    )
+    # backfill
+    insert = "INSERT INTO postcounter (scope, scope_id, total, published) "
+    op.execute(insert +
+               "SELECT 'index', 0, COUNT(*), " + PUBLISHED + " "
+               "FROM post WHERE " + LISTED)
+    op.execute(insert +
+               "SELECT 'author', post.author_id, COUNT(*), " + PUBLISHED + " "
+               "FROM post WHERE post.author_id IS NOT NULL AND " + LISTED + " "
+               "GROUP BY post.author_id")
+    op.execute(insert +
+               "SELECT 'category', post.category_id, COUNT(*), " + PUBLISHED + " "
+               "FROM post WHERE post.category_id IS NOT NULL AND " + LISTED + " "
+               "GROUP BY post.category_id")
+    op.execute(insert +
+               "SELECT 'tag', post_tag.tag_id, COUNT(*), " + PUBLISHED + " "
+               "FROM post JOIN post_tag ON post_tag.post_id = post.id "
+               "WHERE " + LISTED + " "
+               "GROUP BY post_tag.tag_id")
+
+
+def downgrade():
+    op.drop_table('postcounter')
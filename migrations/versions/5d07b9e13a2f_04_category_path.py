@@ -0,0 +1,43 @@
+"""04 Category path
+
+Revision ID: 5d07b9e13a2f
+Revises: c81d4f3a6e20
+Create Date: 2026-10-18 18:10:44.203000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d07b9e13a2f'
+down_revision = 'c81d4f3a6e20'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('category', sa.Column('path', sa.String(length=255), nullable=True))
+    op.create_index(op.f('ix_category_path'), 'category', ['path'], unique=False)
+    # backfill
+    category = sa.table('category',
+                        sa.column('id', sa.Integer),
+                        sa.column('parent_id', sa.Integer),
+                        sa.column('path', sa.String))
+    connection = op.get_bind()
+    parents = dict(connection.execute(sa.select([category.c.id,
+                                                 category.c.parent_id])).fetchall())
+    paths = {}
+    def path(id):
+        if id not in paths:
+            parent = parents[id]
+            paths[id] = (path(parent) if parent is not None else "") + "{}/".format(id)
+        return paths[id]
+    for id in parents:
+        connection.execute(category.update()
+                                   .where(category.c.id == id)
+                                   .values(path=path(id)))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_category_path'), table_name='category')
+    with op.batch_alter_table('category') as batch_op:
+        batch_op.drop_column('path')
@@ -0,0 +1,28 @@
+"""06 Render version
+
+Revision ID: 6a9c2d71f5b8
+Revises: e4b1f6a0c392
+Create Date: 2026-10-18 19:40:51.378000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a9c2d71f5b8'
+down_revision = 'e4b1f6a0c392'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    for table in ('post', 'comment'):
+        op.add_column(table, sa.Column('render_version', sa.Integer(), nullable=True))
+        # stored bodies were rendered by the first version of the renderer
+        op.execute("UPDATE {} SET render_version = 1 "
+                   "WHERE body_html IS NOT NULL".format(table))
+
+
+def downgrade():
+    for table in ('post', 'comment'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('render_version')
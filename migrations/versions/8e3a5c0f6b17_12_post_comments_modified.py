@@ -0,0 +1,23 @@
+"""12 Post comments modified
+
+Revision ID: 8e3a5c0f6b17
+Revises: 2b7f9e4c1d05
+Create Date: 2026-10-19 11:02:18.441000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e3a5c0f6b17'
+down_revision = '2b7f9e4c1d05'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('post', sa.Column('comments_modified', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('post') as batch_op:
+        batch_op.drop_column('comments_modified')
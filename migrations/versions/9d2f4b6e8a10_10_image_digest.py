@@ -0,0 +1,53 @@
+"""10 Image digest
+
+Revision ID: 9d2f4b6e8a10
+Revises: 0c5e7a3b9f18
+Create Date: 2026-10-18 23:02:36.518000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d2f4b6e8a10'
+down_revision = '0c5e7a3b9f18'
+
+import os
+from hashlib import sha256
+from flask import current_app
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('image', sa.Column('digest', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_image_digest'), 'image', ['digest'], unique=True)
+    # backfill from the files as stored (see Image.from_upload); of
+    # several identical ones, only the first image gets the digest.
+    # 'manage.py optimize' updates the digests of the files it rewrites.
+    image = sa.table('image',
+                     sa.column('id', sa.Integer),
+                     sa.column('filename', sa.String),
+                     sa.column('digest', sa.String))
+    connection = op.get_bind()
+    destination = current_app.upload_set_config['images'].destination
+    seen = set()
+    for id, filename in connection.execute(sa.select([image.c.id, image.c.filename])
+                                             .order_by(image.c.id)).fetchall():
+        digest = sha256()
+        try:
+            with open(os.path.join(destination, filename), 'rb') as f:
+                for chunk in iter(lambda: f.read(64 * 1024), b""):
+                    digest.update(chunk)
+        except IOError:
+            continue
+        digest = digest.hexdigest()
+        if digest not in seen:
+            seen.add(digest)
+            connection.execute(image.update()
+                                    .where(image.c.id == id)
+                                    .values(digest=digest))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_image_digest'), table_name='image')
+    with op.batch_alter_table('image') as batch_op:
+        batch_op.drop_column('digest')
@@ -0,0 +1,23 @@
+"""02 Post visibility index
+
+Revision ID: a52e0c7d19b3
+Revises: 3f1c2a9d8e47
+Create Date: 2026-10-18 16:48:30.902000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a52e0c7d19b3'
+down_revision = '3f1c2a9d8e47'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_post_status_page_created', 'post',
+                    ['status', 'page', 'created'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_post_status_page_created', table_name='post')
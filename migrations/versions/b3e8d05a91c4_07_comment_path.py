@@ -0,0 +1,43 @@
+"""07 Comment path
+
+Revision ID: b3e8d05a91c4
+Revises: 6a9c2d71f5b8
+Create Date: 2026-10-18 20:52:17.640000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b3e8d05a91c4'
+down_revision = '6a9c2d71f5b8'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('comment', sa.Column('path', sa.String(length=255), nullable=True))
+    op.create_index(op.f('ix_comment_path'), 'comment', ['path'], unique=False)
+    # backfill, with ids padded to ten digits as in Comment._path_digits
+    comment = sa.table('comment',
+                       sa.column('id', sa.Integer),
+                       sa.column('parent_id', sa.Integer),
+                       sa.column('path', sa.String))
+    connection = op.get_bind()
+    parents = dict(connection.execute(sa.select([comment.c.id,
+                                                 comment.c.parent_id])).fetchall())
+    paths = {}
+    def path(id):
+        if id not in paths:
+            parent = parents[id]
+            paths[id] = (path(parent) if parent is not None else "") + "{:010d}/".format(id)
+        return paths[id]
+    for id in parents:
+        connection.execute(comment.update()
+                                  .where(comment.c.id == id)
+                                  .values(path=path(id)))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_comment_path'), table_name='comment')
+    with op.batch_alter_table('comment') as batch_op:
+        batch_op.drop_column('path')
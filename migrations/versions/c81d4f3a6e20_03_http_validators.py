@@ -0,0 +1,26 @@
+"""03 HTTP validators
+
+Revision ID: c81d4f3a6e20
+Revises: a52e0c7d19b3
+Create Date: 2026-10-18 17:32:05.118000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c81d4f3a6e20'
+down_revision = 'a52e0c7d19b3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('postcounter', sa.Column('modified', sa.DateTime(), nullable=True))
+    op.execute("UPDATE postcounter SET modified = CURRENT_TIMESTAMP")
+    op.create_index(op.f('ix_comment_post_id'), 'comment', ['post_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_comment_post_id'), table_name='comment')
+    with op.batch_alter_table('postcounter') as batch_op:
+        batch_op.drop_column('modified')
@@ -0,0 +1,49 @@
+"""05 Association keys
+
+Revision ID: e4b1f6a0c392
+Revises: 5d07b9e13a2f
+Create Date: 2026-10-18 19:02:17.655000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e4b1f6a0c392'
+down_revision = '5d07b9e13a2f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+TABLES = (('post_tag', 'tag'), ('post_image', 'image'))
+
+
+def rebuild(table, other, keys):
+    """
+    Copy table into a new one (duplicate rows dropped) and swap them.
+    """
+    column = other + '_id'
+    op.create_table(table + '_new',
+    sa.Column('post_id', sa.Integer(), nullable=not keys),
+    sa.Column(column, sa.Integer(), nullable=not keys),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint([column], [other + '.id'], ),
+    *([sa.PrimaryKeyConstraint('post_id', column)] if keys else [])
+    )
+    op.execute("INSERT INTO {0}_new (post_id, {1}) "
+               "SELECT DISTINCT post_id, {1} FROM {0} "
+               "WHERE post_id IS NOT NULL AND {1} IS NOT NULL".format(table, column))
+    op.drop_table(table)
+    op.rename_table(table + '_new', table)
+    if keys:
+        op.create_index('ix_{0}_{1}_post_id'.format(table, column),
+                        table, [column, 'post_id'], unique=False)
+
+
+def upgrade():
+    for table, other in TABLES:
+        rebuild(table, other, keys=True)
+
+
+def downgrade():
+    for table, other in TABLES:
+        rebuild(table, other, keys=False)
@@ -0,0 +1,39 @@
+"""08 Comment avatar hash
+
+Revision ID: f7a41c9e2d63
+Revises: b3e8d05a91c4
+Create Date: 2026-10-18 21:34:05.912000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f7a41c9e2d63'
+down_revision = 'b3e8d05a91c4'
+
+from hashlib import md5
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('comment', sa.Column('avatar_hash', sa.String(length=32), nullable=True))
+    # backfill guest comments
+    comment = sa.table('comment',
+                       sa.column('id', sa.Integer),
+                       sa.column('author_email', sa.String),
+                       sa.column('avatar_hash', sa.String))
+    connection = op.get_bind()
+    rows = connection.execute(sa.select([comment.c.id, comment.c.author_email])
+                                .where(comment.c.author_email != None)).fetchall()
+    if rows:
+        connection.execute(comment.update()
+                                  .where(comment.c.id == sa.bindparam('_id'))
+                                  .values(avatar_hash=sa.bindparam('_hash')),
+                           [{ '_id': id,
+                              '_hash': md5(email.lower().encode('utf-8')).hexdigest() }
+                            for id, email in rows])
+
+
+def downgrade():
+    with op.batch_alter_table('comment') as batch_op:
+        batch_op.drop_column('avatar_hash')
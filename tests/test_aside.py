@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import unittest
+from flask.ext.sqlalchemy import get_debug_queries
+from app import create_app, db, aside
+from app.models.users import Role, User
+from app.models.content import Post, Tag
+
+
+class AsideTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.request_context = self.app.test_request_context()
+        self.request_context.push()
+        self.author = User(email=u"u@example.com", username=u"u", password=u"cat")
+        db.session.add(self.author)
+        db.session.commit()
+
+    def tearDown(self):
+        self.request_context.pop()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_post(self, tags, status=True):
+        db.session.add(Post(name=u"Post {}".format(Post.query.count()),
+                            body_md=u"body",
+                            status=status,
+                            author=self.author,
+                            tags=tags))
+        db.session.commit()
+
+    # tag cloud
+    def test_tag_cloud_weights_published_posts(self):
+        popular, rare, draft = Tag(name=u"popular"), Tag(name=u"rare"), Tag(name=u"draft")
+        self.add_post([popular, rare])
+        self.add_post([popular])
+        self.add_post([popular, draft], status=False)
+        tags = aside.tag_cloud.tags()
+        self.assertEqual([(t['name'], t['weight']) for t in tags],
+                         [(u"popular", 5), (u"rare", 1)])
+
+    def test_tag_cloud_is_cached_until_posts_change(self):
+        tag = Tag(name=u"first")
+        self.add_post([tag])
+        self.assertIn(u"first", aside.tag_cloud())
+        before = len(get_debug_queries())
+        aside.tag_cloud()
+        self.assertEqual(len(get_debug_queries()) - before, 0)
+        self.add_post([Tag(name=u"second")])
+        self.assertIn(u"second", aside.tag_cloud())
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import re
+import json
+import unittest
+from hashlib import md5
+from flask.ext.sqlalchemy import get_debug_queries
+from app import create_app, db
+from app.models.users import Role, User
+from app.models.content import Post, Comment
+
+
+class CommentsTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+        self.author = User(email=u"u@example.com", username=u"u", password=u"cat")
+        self.post = Post(name=u"First", body_md=u"body", status=True,
+                         author=self.author)
+        db.session.add_all([self.author, self.post])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def comment(self, body, parent=None):
+        c = Comment(post=self.post, body_md=body, parent=parent,
+                    author_name=u"guest", author_email=u"g@example.com")
+        db.session.add(c)
+        db.session.commit()
+        return c
+
+    def test_thread_is_ordered_by_path(self):
+        a = self.comment(u"a")
+        b = self.comment(u"b")
+        a1 = self.comment(u"a1", a)
+        b1 = self.comment(u"b1", b)
+        a2 = self.comment(u"a2", a)
+        self.assertEqual(a1.path, "{:010d}/{:010d}/".format(a.id, a1.id))
+        db.session.expunge_all()
+        thread = Comment.thread(Post.query.first()).items
+        self.assertEqual([c.body_md for c in thread], [u"a", u"b"])
+        self.assertEqual([c.body_md for c in thread[0].replies], [u"a1", u"a2"])
+        self.assertEqual([c.body_md for c in thread[1].replies], [u"b1"])
+
+    def test_post_page_loads_comments_in_one_query(self):
+        for i in range(5):
+            parent = self.comment(u"comment {}".format(i))
+            self.comment(u"reply {}".format(i), parent)
+        db.session.expunge_all()
+        before = len(get_debug_queries())
+        data = self.client.get('/first').get_data(as_text=True)
+        queries = [q for q in get_debug_queries()[before:]
+                   if "FROM comment" in q.statement]
+        self.assertEqual(len(queries), 3) # validators, threads, replies
+        self.assertIn(u"reply 4", data)
+
+    def test_comments_are_paginated(self):
+        self.app.config['COMMENTS_PER_PAGE'] = 2
+        for i in range(3):
+            parent = self.comment(u"comment {}".format(i))
+            self.comment(u"reply {}".format(i), parent)
+        data = self.client.get('/first').get_data(as_text=True)
+        self.assertIn(u"reply 1", data)
+        self.assertNotIn(u"comment 2", data)
+        more = re.search(r'class="more-comments"><a href="([^"]+)"', data).group(1)
+        response = json.loads(self.client.get(more).get_data(as_text=True))
+        self.assertIn(u"comment 2", response['html'])
+        self.assertIn(u"reply 2", response['html'])
+        self.assertNotIn(u"comment 1", response['html'])
+        self.assertIsNone(response['next'])
+
+    def test_replies_beyond_max_depth_go_up(self):
+        self.app.config['COMMENT_MAX_DEPTH'] = 2
+        a = self.comment(u"a")
+        a1 = self.comment(u"a1", a)
+        self.assertEqual(Comment.parent_for(a), a)
+        self.assertEqual(Comment.parent_for(a1), a)
+        self.app.config['COMMENT_MAX_DEPTH'] = 1
+        self.assertIsNone(Comment.parent_for(a1))
+
+    def test_comment_count_is_kept_in_sql(self):
+        other = Post(name=u"Other", body_md=u"body", author=self.author)
+        db.session.add(other)
+        a = self.comment(u"a")
+        b = self.comment(u"b", a)
+        self.assertEqual(self.post.comment_count, 2)
+        b.parent = None
+        b.post = other
+        db.session.commit()
+        self.assertEqual((self.post.comment_count, other.comment_count), (1, 1))
+        db.session.delete(a)
+        db.session.commit()
+        self.assertEqual(self.post.comment_count, 0)
+
+    def test_reconcile_comment_counts(self):
+        self.comment(u"a")
+        self.comment(u"b")
+        db.session.execute(Post.__table__.update().values(comment_count=7))
+        db.session.commit()
+        self.assertEqual(Post.reconcile_comment_counts(), 1)
+        self.assertEqual(self.post.comment_count, 2)
+        self.assertEqual(Post.reconcile_comment_counts(), 0)
+
+    def test_guest_avatar_hash_is_stored(self):
+        c = self.comment(u"a")
+        self.assertEqual(c.avatar_hash, md5(b"g@example.com").hexdigest())
+        with self.app.test_request_context('/'):
+            self.assertIn(c.avatar_hash + "?s=40", c.gravatar(size=40))
+            self.assertIs(c.gravatar(size=40), c.gravatar(size=40)) # memoized
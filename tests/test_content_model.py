@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from hashlib import sha256
+from threading import ThreadError
+from flask.ext.sqlalchemy import get_debug_queries
+from flask.ext.uploads import configure_uploads
+from app import create_app, db, category_tree, tasks, render_cache, images, imaging
+from app.render import RENDER_VERSION
+from app.models.users import Role, User
+from app.models.content import Post, Category, Tag, Image, PostCounter
+
+
+class ContentModelTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.author = User(email=u"u@example.com", username=u"u", password=u"cat")
+        db.session.add(self.author)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    # post counters
+    def test_counters_follow_post_lifecycle(self):
+        tag = Tag(name=u"tag")
+        p = Post(name=u"post", body_md=u"body", author=self.author)
+        p.tags.append(tag)
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual(PostCounter.get('index'), 1)
+        self.assertEqual(PostCounter.get('index', published=True), 0)
+        self.assertEqual(PostCounter.get('tag', tag.id), 1)
+        self.assertEqual(PostCounter.get('author', self.author.id), 1)
+        # publish
+        p.change_status()
+        db.session.commit()
+        self.assertEqual(PostCounter.get('index', published=True), 1)
+        self.assertEqual(PostCounter.get('tag', tag.id, published=True), 1)
+        # move to a category, drop the tag
+        c = Category(name=u"category")
+        p.category = c
+        p.tags.remove(tag)
+        db.session.commit()
+        self.assertEqual(PostCounter.get('category', c.id, published=True), 1)
+        self.assertEqual(PostCounter.get('tag', tag.id), 0)
+        self.assertEqual(PostCounter.get('tag', tag.id, published=True), 0)
+        # delete
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(PostCounter.get('index'), 0)
+        self.assertEqual(PostCounter.get('index', published=True), 0)
+        self.assertEqual(PostCounter.get('category', c.id), 0)
+        self.assertEqual(PostCounter.get('author', self.author.id), 0)
+
+    def test_pages_are_not_counted(self):
+        db.session.add(Post(name=u"page", body_md=u"body", page=True))
+        db.session.commit()
+        self.assertEqual(PostCounter.get('index'), 0)
+
+    def test_counters_follow_foreign_keys(self):
+        c1, c2 = Category(name=u"c1"), Category(name=u"c2")
+        db.session.add_all([c1, c2])
+        db.session.commit()
+        p = Post(name=u"post", body_md=u"body", author_id=self.author.id,
+                 category_id=c1.id)
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual(PostCounter.get('author', self.author.id), 1)
+        self.assertEqual(PostCounter.get('category', c1.id), 1)
+        p.category_id = c2.id # attributes expired by the commit
+        db.session.commit()
+        self.assertEqual(PostCounter.get('category', c1.id), 0)
+        self.assertEqual(PostCounter.get('category', c2.id), 1)
+
+    def test_counters_of_deleted_scopes_go(self):
+        tag = Tag(name=u"tag")
+        p = Post(name=u"post", body_md=u"body", author=self.author)
+        p.tags.append(tag)
+        db.session.add(p)
+        db.session.commit()
+        tag_id = tag.id
+        p.tags.remove(tag)
+        db.session.delete(tag)
+        db.session.commit()
+        self.assertEqual(PostCounter.query.filter_by(scope='tag', scope_id=tag_id).count(), 0)
+
+    def test_counters_rebuild(self):
+        tag = Tag(name=u"tag")
+        p = Post(name=u"post", body_md=u"body", author=self.author, status=True)
+        p.tags.append(tag)
+        db.session.add_all([p, Post(name=u"page", body_md=u"body", page=True)])
+        db.session.commit()
+        self.assertEqual(PostCounter.rebuild(), 0)
+        PostCounter.query.filter_by(scope='index').update({'total': 7})
+        PostCounter.query.filter_by(scope='tag').delete()
+        db.session.add(PostCounter(scope='tag', scope_id=tag.id + 1, total=3))
+        db.session.commit()
+        self.assertEqual(PostCounter.rebuild(), 3)
+        self.assertEqual(PostCounter.get('index'), 1)
+        self.assertEqual(PostCounter.get('tag', tag.id, published=True), 1)
+        self.assertEqual(PostCounter.get('tag', tag.id + 1), 0)
+        self.assertEqual(PostCounter.get('author', self.author.id, published=True), 1)
+
+    # category paths
+    def test_category_paths_follow_reparenting(self):
+        root = Category(name=u"root")
+        child = Category(name=u"child", parent=root)
+        leaf = Category(name=u"leaf", parent=child)
+        other = Category(name=u"other")
+        db.session.add_all([leaf, other])
+        db.session.commit()
+        self.assertEqual(leaf.path, u"{0}/{1}/{2}/".format(root.id, child.id, leaf.id))
+        self.assertEqual(leaf.ancestor_ids, [root.id, child.id])
+        self.assertEqual(root.descendants().count(), 2)
+        # move child (and leaf with it) under other
+        child.parent = other
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(leaf.path, u"{0}/{1}/{2}/".format(other.id, child.id, leaf.id))
+        self.assertEqual(root.descendants().count(), 0)
+        self.assertEqual([c.name for c in leaf.lineage()],
+                         [u"other", u"child", u"leaf"])
+
+    def test_tree_loads_ancestors_in_one_query(self):
+        c = Category(name=u"c", parent=Category(name=u"b", parent=Category(name=u"a")))
+        db.session.add(c)
+        db.session.commit()
+        id = c.id
+        db.session.remove()
+        c = Category.query.get(id)
+        before = len(get_debug_queries())
+        self.assertEqual(c.tree(linked=False), u"a > b > c")
+        self.assertEqual(len(get_debug_queries()) - before, 1)
+
+    # category tree
+    def test_category_tree_is_built_once(self):
+        db.session.add(Category(name=u"b", parent=Category(name=u"a")))
+        db.session.commit()
+        [(a, b)] = [(n, n.children[0]) for n in category_tree.roots]
+        before = len(get_debug_queries())
+        self.assertEqual(b.tree(linked=False), u"a > b")
+        self.assertEqual([n.name for n in category_tree.walk()], [u"a", u"b"])
+        self.assertEqual(len(get_debug_queries()) - before, 0)
+
+    def test_category_tree_follows_commits(self):
+        c = Category(name=u"old name")
+        db.session.add(c)
+        db.session.commit()
+        self.assertEqual(category_tree.get(c.id).name, u"old name")
+        c.name = u"new name"
+        db.session.commit()
+        self.assertEqual(category_tree.get(c.id).name, u"new name")
+
+    def test_category_tree_drops_deleted_categories(self):
+        c = Category(name=u"gone")
+        db.session.add(c)
+        db.session.commit()
+        id = c.id
+        self.assertIsNotNone(category_tree.get(id))
+        db.session.delete(c)
+        db.session.commit()
+        self.assertIsNone(category_tree.get(id))
+
+    def test_category_tree_sees_other_processes(self):
+        c = Category(name=u"old name")
+        db.session.add(c)
+        db.session.commit()
+        self.assertEqual(category_tree.get(c.id).name, u"old name")
+        # as committed by another worker: no local invalidation
+        table = Category.__table__
+        db.session.execute(table.update()
+                                .where(table.c.id == c.id)
+                                .values(name=u"new name")) # bumps modified
+        db.session.commit()
+        self.assertEqual(category_tree.get(c.id).name, u"old name") # same request
+        with self.app.app_context(): # next request
+            self.assertEqual(category_tree.get(c.id).name, u"new name")
+
+    # slugs
+    def test_slugs_are_allocated_in_one_query_per_flush(self):
+        db.session.add(Tag(name=u"Update"))
+        db.session.commit()
+        before = len(get_debug_queries())
+        tags = [Tag(name=name) for name in (u"update!", u"UPDATE", u"Other")]
+        db.session.add_all(tags)
+        db.session.commit()
+        slug_queries = [q for q in get_debug_queries()[before:]
+                        if q.statement.startswith("SELECT tag.slug")]
+        self.assertEqual(len(slug_queries), 1)
+        self.assertEqual([t.slug for t in tags], [u"update-2", u"update-3", u"other"])
+        self.assertEqual(Tag.allocate_slugs([u"Update", u"Update", u"new"]),
+                         [u"update-4", u"update-5", u"new"])
+
+    def test_same_title_slugs_follow_insertion_order(self):
+        # names are unique, their slug bases aren't
+        posts = [Post(name=u"Same title" + u"!" * i, body_md=u"body", author=self.author)
+                 for i in range(8)]
+        for post in posts:
+            db.session.add(post)
+        db.session.flush()
+        self.assertEqual([p.slug for p in posts],
+                         [u"same-title"] + [u"same-title-{}".format(i) for i in range(2, 9)])
+
+    def test_renaming_keeps_a_fitting_slug(self):
+        tag = Tag(name=u"foo")
+        db.session.add_all([tag, Tag(name=u"bar")])
+        db.session.commit()
+        tag.name = u"Foo"
+        db.session.commit()
+        self.assertEqual(tag.slug, u"foo")
+        tag.name = u"Bar"
+        db.session.commit()
+        self.assertEqual(tag.slug, u"bar-2")
+
+    # rendering
+    def test_bodies_render_in_the_background(self):
+        self.app.config['RENDER_ASYNC'] = True
+        p = Post(name=u"post", body_md=u"*body*", author=self.author)
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual(p.html(), u"<p><em>body</em></p>") # either way
+        tasks.join()
+        db.session.expire(p)
+        self.assertEqual(p.render_version, RENDER_VERSION)
+        self.assertEqual(p.body_html, u"<p><em>body</em></p>")
+
+    def test_background_failures_are_logged(self):
+        records = []
+        handler = logging.Handler(logging.ERROR)
+        handler.emit = records.append
+        self.app.logger.addHandler(handler)
+        try:
+            def broken():
+                raise ValueError("broken")
+            tasks.enqueue(broken)
+            tasks.join()
+        finally:
+            self.app.logger.removeHandler(handler)
+        self.assertEqual([r.getMessage() for r in records], [u"Background task broken failed"])
+        self.assertIs(records[0].exc_info[0], ValueError)
+
+    def test_bodies_render_without_threads(self):
+        def no_thread(count):
+            raise ThreadError("can't start new thread")
+        workers, start = tasks._workers, tasks._start
+        tasks._workers, tasks._start = [], no_thread
+        try:
+            self.app.config['RENDER_ASYNC'] = True
+            p = Post(name=u"post", body_md=u"*body*", author=self.author)
+            db.session.add(p)
+            db.session.commit()
+            tasks.join() # as the app context ends
+        finally:
+            tasks._workers, tasks._start = workers, start
+        db.session.expire(p)
+        self.assertEqual(p.render_version, RENDER_VERSION)
+        self.assertEqual(p.body_html, u"<p><em>body</em></p>")
+
+    def test_unchanged_body_is_not_rendered_again(self):
+        p = Post(name=u"post", body_md=u"body", author=self.author)
+        db.session.add(p)
+        db.session.commit()
+        Post.query.filter_by(id=p.id).update({'body_html': u"kept"})
+        db.session.commit()
+        p.body_md = u"body"
+        db.session.commit()
+        self.assertEqual(p.body_html, u"kept")
+
+    def test_identical_bodies_share_a_render(self):
+        key = render_cache.key(u"thanks! (shared)")
+        self.assertIsNone(render_cache.local.get(key))
+        db.session.add(Post(name=u"post", body_md=u"thanks! (shared)", author=self.author))
+        self.assertEqual(render_cache.local.get(key), u"<p>thanks! (shared)</p>")
+
+    # photos in bodies
+    def test_photos_are_resolved_in_one_query(self):
+        db.session.add_all([Image(filename=u"a.jpg"), Image(filename=u"b.png")])
+        db.session.commit()
+        before = len(get_debug_queries())
+        p = Post(name=u"trip", author=self.author,
+                 body_md=u"!(a.jpg)\n\n!(b.png)\n\n!(a.jpg)\n\n!(missing.jpg)")
+        image_queries = [q for q in get_debug_queries()[before:]
+                         if "FROM image" in q.statement]
+        self.assertEqual(len(image_queries), 1)
+        self.assertEqual(sorted(i.filename for i in p.images), [u"a.jpg", u"b.png"])
+        self.assertEqual(p.body_html.count(u'src="/static/uploads/images/a.jpg"'), 2)
+        self.assertIn(u"!(missing.jpg)", p.body_html)
+
+    # image variants
+    def test_img_offers_variants(self):
+        i = Image(filename=u"a.jpg", width=2000, variant_widths="120,480,960")
+        db.session.add(i)
+        db.session.commit()
+        tag = i.img(width=120)
+        self.assertIn(u'src="/static/uploads/images/a-120w.jpg"', tag)
+        self.assertIn(u'/static/uploads/images/a-960w.jpg 960w, '
+                      u'/static/uploads/images/a.jpg 2000w"', tag)
+        self.assertIn(u'sizes="120px"', tag)
+        self.assertIn(u'src="/static/uploads/images/a.jpg"', i.img())
+        self.assertNotIn(u'srcset', Image(filename=u"b.jpg").img())
+
+    def test_body_photos_keep_their_srcset(self):
+        db.session.add(Image(filename=u"a.jpg", width=2000, variant_widths="480,960"))
+        db.session.commit()
+        p = Post(name=u"trip", body_md=u"!(a.jpg)", author=self.author)
+        self.assertIn(u'srcset="/static/uploads/images/a-480w.jpg 480w', p.body_html)
+        self.assertIn(u'sizes="480px"', p.body_html)
+
+    @unittest.skipIf(imaging.PILImage is None, "needs Pillow")
+    def test_variants_are_made_after_upload(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.app.config['UPLOADED_IMAGES_DEST'] = directory
+            self.app.config['UPLOADED_IMAGES_URL'] = '/static/uploads/images/'
+            configure_uploads(self.app, images)
+            imaging.PILImage.new("RGB", (600, 400)).save(os.path.join(directory, "a.jpg"))
+            i = Image(filename=u"a.jpg")
+            db.session.add(i)
+            db.session.flush()
+            p = Post(name=u"trip", body_md=u"!(a.jpg)", author=self.author)
+            db.session.add(p)
+            db.session.commit()
+            self.assertNotIn(u"srcset", p.body_html)
+            tasks.join()
+            db.session.expire_all()
+            self.assertEqual((i.width, i.variant_widths), (600, "120,480"))
+            self.assertTrue(os.path.exists(os.path.join(directory, "a-480w.jpg")))
+            # the body is rendered again, with the variants
+            self.assertEqual(p.render_version, RENDER_VERSION)
+            self.assertIn(u'srcset="/static/uploads/images/a-120w.jpg 120w', p.body_html)
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(imaging.PILImage is None, "needs Pillow")
+    def test_variants_render_in_the_background_without_base_url(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.app.config['UPLOADED_IMAGES_DEST'] = directory # no UPLOADED_IMAGES_URL
+            self.app.config['RENDER_ASYNC'] = True
+            configure_uploads(self.app, images)
+            imaging.PILImage.new("RGB", (600, 400)).save(os.path.join(directory, "a.jpg"))
+            i = Image(filename=u"a.jpg")
+            db.session.add(i)
+            db.session.flush()
+            p = Post(name=u"trip", body_md=u"!(a.jpg)", author=self.author)
+            db.session.add(p)
+            db.session.commit()
+            tasks.join() # variants, then the render they trigger
+            tasks.join()
+            db.session.expire_all()
+            self.assertEqual(i.variant_widths, "120,480")
+            self.assertEqual(p.render_version, RENDER_VERSION)
+            self.assertIn(u'srcset="/_uploads/images/a-120w.jpg 120w', p.body_html)
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(imaging.PILImage is None, "needs Pillow")
+    def test_uploads_are_hashed_as_stored(self):
+        from io import BytesIO
+        from werkzeug.datastructures import FileStorage
+        directory = tempfile.mkdtemp()
+        try:
+            self.app.config['UPLOADED_IMAGES_DEST'] = directory
+            configure_uploads(self.app, images)
+            photo = BytesIO()
+            imaging.PILImage.frombytes("L", (64, 64), os.urandom(64 * 64)).save(
+                photo, "JPEG", quality=100)
+            upload = lambda: FileStorage(BytesIO(photo.getvalue()), u"a.jpg")
+            i = Image.from_upload(upload())
+            db.session.add(i)
+            db.session.commit()
+            path = images.path(i.filename)
+            self.assertTrue(os.path.getsize(path) < len(photo.getvalue()))
+            self.assertEqual(i.digest, imaging.file_digest(path))
+            self.assertEqual(i.upload_digest, sha256(photo.getvalue()).hexdigest())
+            self.assertIn(i.upload_digest, i.filename)
+            # found again by the uploaded bytes, however they'd be optimized now
+            self.app.config['IMAGE_QUALITY'] = 30
+            self.assertIs(Image.from_upload(upload()), i)
+            # a file rewritten in place gets its digest again, under its name
+            filename = i.filename
+            imaging.PILImage.new("L", (8, 8)).save(path, "PNG")
+            self.assertEqual(Image.refresh_digests([path]), 1)
+            self.assertEqual((i.filename, i.digest), (filename, imaging.file_digest(path)))
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(imaging.PILImage is None, "needs Pillow")
+    def test_optimize_reencodes_once(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "a.jpg")
+            image = imaging.PILImage.frombytes("L", (64, 64), os.urandom(64 * 64))
+            image.save(path, "JPEG", quality=100)
+            before, after = imaging.optimize(path, quality=60)
+            self.assertTrue(after < before)
+            self.assertEqual(os.path.getsize(path), after)
+            self.assertIn('progressive', imaging.PILImage.open(path).info)
+            self.assertEqual(imaging.optimize(path, quality=60), (after, after))
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(imaging.PILImage is None, "needs Pillow")
+    def test_optimize_strips_metadata_even_without_savings(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "a.jpg")
+            image = imaging.PILImage.frombytes("L", (64, 64), os.urandom(64 * 64))
+            exif = b"Exif\x00\x00MM\x00*\x00\x00\x00\x08\x00\x00" # empty IFD
+            image.save(path, "JPEG", quality=40, exif=exif)
+            imaging.optimize(path, quality=95) # can't shrink it at that quality
+            optimized = imaging.PILImage.open(path)
+            self.assertNotIn('exif', optimized.info)
+            self.assertTrue(imaging._optimized(optimized))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_rerender_in_batches(self):
+        posts = [Post(name=u"post {}".format(i), body_md=u"*{}*".format(i),
+                      author=self.author) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        Post.query.update({'body_html': u"stale"})
+        db.session.commit()
+        ids = sorted(p.id for p in posts)
+        batches = list(Post.rerender(after=ids[0], batch=2))
+        self.assertEqual(batches, [(ids[2], 2), (ids[4], 2)])
+        db.session.expire_all()
+        self.assertEqual([p.body_html for p in Post.query.order_by(Post.id)],
+                         [u"stale"] + [u"<p><em>{}</em></p>".format(i) for i in range(1, 5)])
+
+    def test_rerender_leaves_edits_alone(self):
+        p = Post(name=u"post", body_md=u"*old*", author=self.author)
+        db.session.add(p)
+        db.session.commit()
+        def edited_meanwhile(f, jobs):
+            results = map(f, jobs)
+            db.session.execute(Post.__table__.update().values(body_md=u"*new*",
+                                                              body_html=u"<p><em>new</em></p>"))
+            return results
+        self.assertEqual(list(Post.rerender(map=edited_meanwhile)), [(p.id, 1)])
+        db.session.expire_all()
+        self.assertEqual(p.body_html, u"<p><em>new</em></p>")
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from flask.ext.sqlalchemy import get_debug_queries
+from app import create_app, db, page_cache
+from app.cache import FileSystemCache
+from app.models.users import Role, User
+from app.models.content import Post, Category, Tag
+
+
+class PageCacheTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['PAGE_CACHE_TYPE'] = 'lru'
+        page_cache.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+        self.author = User(email=u"u@example.com", username=u"u", password=u"cat")
+        self.post = Post(name=u"First", body_md=u"body", status=True,
+                         author=self.author)
+        db.session.add_all([self.author, self.post, Category(name=u"Pruebas")])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, url):
+        before = len(get_debug_queries())
+        data = self.client.get(url).get_data(as_text=True)
+        return data, len(get_debug_queries()) - before
+
+    def test_second_hit_runs_no_queries(self):
+        first, queries = self.get('/')
+        self.assertTrue(queries > 0)
+        second, queries = self.get('/')
+        self.assertEqual(queries, 0)
+        self.assertEqual(first, second)
+
+    def test_new_post_invalidates_index(self):
+        self.get('/')
+        db.session.add(Post(name=u"Second", body_md=u"body", status=True,
+                            author=self.author))
+        db.session.commit()
+        data, queries = self.get('/')
+        self.assertIn(u"Second", data)
+
+    def test_tag_change_invalidates_every_page(self):
+        tag = Tag(name=u"old tag")
+        other = Post(name=u"Other", body_md=u"body", status=True,
+                     author=self.author, tags=[tag])
+        db.session.add(other)
+        db.session.commit()
+        self.get('/first')
+        tag.name = u"new tag"
+        db.session.commit()
+        data, queries = self.get('/first')
+        self.assertIn(u"new tag", data)
+
+    def test_unrelated_post_keeps_post_page(self):
+        self.get('/first')
+        db.session.add(Post(name=u"Page", body_md=u"body", page=True))
+        db.session.commit()
+        data, queries = self.get('/first')
+        self.assertEqual(queries, 0)
+
+    def test_csrf_token_is_not_shared(self):
+        first, queries = self.get('/first')
+        self.client.cookie_jar.clear()
+        second, queries = self.get('/first')
+        self.assertEqual(queries, 0)
+        self.assertNotIn(page_cache.csrf_placeholder, second)
+        self.assertNotEqual(first, second)
+
+    def test_invalidation_while_rendering_is_not_lost(self):
+        rendered = []
+        @self.app.route('/racy')
+        @page_cache.cached
+        def racy():
+            page_cache.depends('post:{}'.format(self.post.id))
+            rendered.append(True)
+            if len(rendered) == 1: # a commit lands while the page renders
+                page_cache.invalidate('post:{}'.format(self.post.id))
+            return u"page"
+        self.get('/racy')
+        self.get('/racy')
+        self.assertEqual(len(rendered), 2)
+        self.get('/racy')
+        self.assertEqual(len(rendered), 2)
+
+
+class FileSystemCacheTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = FileSystemCache(self.directory, threshold=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_expired_files_go_when_read(self):
+        self.cache.set('a', 1, timeout=-1) # already expired
+        path = self.cache._path('a')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertFalse(os.path.exists(path))
+
+    def test_set_prunes_past_threshold(self):
+        for i in range(9):
+            self.cache.set('version:{}'.format(i), i)
+        self.cache.set('expired', 0, timeout=-1)
+        self.assertEqual(len(os.listdir(self.directory)), 10)
+        self.cache.set('new', 'x') # 11 files: the expired one, then the oldest go
+        self.assertEqual(len(os.listdir(self.directory)), 9)
+        self.assertFalse(os.path.exists(self.cache._path('expired')))
+        self.assertEqual(self.cache.get('new'), 'x')
+
+    def test_clear_leaves_directories(self):
+        os.mkdir(os.path.join(self.directory, 'render'))
+        self.cache.set('a', 1)
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.directory), ['render'])
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import re
+import unittest
+from flask.ext.sqlalchemy import get_debug_queries
+from app import create_app, db, category_tree
+from app.models.users import Role, User
+from app.models.content import Post, Category, Tag, Comment
+
+
+class PostListTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+        self.author = User(email=u"u@example.com", username=u"u", password=u"cat")
+        self.category = Category(name=u"Child", parent=Category(name=u"Pruebas"))
+        db.session.add_all([self.author, self.category])
+        db.session.commit()
+        category_tree.roots # built once per process
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_posts(self, count, status=True):
+        offset = Post.query.count()
+        for i in range(offset, offset + count):
+            p = Post(name=u"Post {}".format(i),
+                     body_md=u"body",
+                     status=status,
+                     author=self.author,
+                     category=self.category)
+            p.tags.append(Tag(name=u"Tag {}".format(i)))
+            db.session.add(p)
+        db.session.commit()
+        db.session.expire_all()
+
+    def count_queries(self, url, per_page):
+        self.app.config['POSTS_PER_PAGE'] = per_page
+        before = len(get_debug_queries())
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(get_debug_queries()) - before
+
+    # eager loading
+    def test_index_queries_do_not_grow_with_page_size(self):
+        self.add_posts(2)
+        few = self.count_queries('/', 2)
+        self.add_posts(8)
+        many = self.count_queries('/', 10)
+        self.assertEqual(few, many)
+
+    def test_author_queries_do_not_grow_with_page_size(self):
+        self.add_posts(2)
+        few = self.count_queries('/author/u', 2)
+        self.add_posts(8)
+        many = self.count_queries('/author/u', 10)
+        self.assertEqual(few, many)
+
+    # projection
+    def test_index_does_not_load_post_bodies(self):
+        self.add_posts(2)
+        before = len(get_debug_queries())
+        self.client.get('/')
+        statements = [q.statement for q in get_debug_queries()[before:]]
+        self.assertFalse([s for s in statements if 'body_html' in s])
+
+    # visibility
+    def test_anonymous_pages_are_full_of_published_posts(self):
+        self.app.config['POSTS_PER_PAGE'] = 2
+        self.add_posts(2)
+        self.add_posts(3, status=False)
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertEqual(re.findall(r'>(Post \d+)</a>', data),
+                         [u"Post 1", u"Post 0"])
+        self.assertNotIn(u"page=2", data)
+        self.assertEqual(self.client.get('/?page=2').status_code, 404)
+
+    # keyset pagination
+    def test_keyset_pagination_walks_every_post_once(self):
+        self.app.config['POSTS_PER_PAGE'] = 2
+        self.app.config['POSTS_KEYSET_PAGINATION'] = True
+        self.add_posts(5)
+        names = []
+        url = '/'
+        while url is not None:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            data = response.get_data(as_text=True)
+            names.extend(re.findall(r'>(Post \d+)</a>', data))
+            after = re.search(r'href="(/\?after=[^"]+)"', data)
+            url = after.group(1).replace('&amp;', '&') if after else None
+        self.assertEqual(names, [u"Post {}".format(i) for i in range(4, -1, -1)])
+
+    def test_keyset_pagination_rejects_forged_cursor(self):
+        self.app.config['POSTS_KEYSET_PAGINATION'] = True
+        response = self.client.get('/?after=forged')
+        self.assertEqual(response.status_code, 404)
+
+    # conditional requests
+    def test_unchanged_index_is_not_modified(self):
+        self.add_posts(2)
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.add_posts(1)
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_new_comment_modifies_listings(self):
+        self.add_posts(1)
+        urls = ['/', '/category/child', '/tag/tag-0', '/author/u']
+        etags = [self.client.get(url).headers['ETag'] for url in urls]
+        post = Post.query.first()
+        modified = post.modified
+        db.session.add(Comment(post=post, body_md=u"first!",
+                               author_name=u"guest", author_email=u"g@example.com"))
+        db.session.commit()
+        for url, etag in zip(urls, etags):
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200, url)
+        # a comment isn't an edit
+        db.session.expire(post)
+        self.assertEqual(post.modified, modified)
+        self.assertIsNotNone(post.comments_modified)
+
+    def test_unchanged_post_is_not_modified(self):
+        self.add_posts(1)
+        response = self.client.get('/post-0')
+        self.assertIsNotNone(response.last_modified)
+        response = self.client.get('/post-0', headers={
+            'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    # category subtrees
+    def test_category_page_lists_subcategories(self):
+        self.add_posts(2)
+        p = Post(name=u"Parent post", body_md=u"body", status=True,
+                 author=self.author, category=self.category.parent)
+        db.session.add(p)
+        db.session.commit()
+        # off by default
+        data = self.client.get('/category/pruebas').get_data(as_text=True)
+        self.assertNotIn(u"Post 0", data)
+        self.app.config['CATEGORY_LIST_SUBTREE'] = True
+        data = self.client.get('/category/pruebas').get_data(as_text=True)
+        self.assertEqual(re.findall(r'>((?:Parent p|P)ost(?: \d+)?)</a>', data),
+                         [u"Parent post", u"Post 1", u"Post 0"])
+        data = self.client.get('/category/child').get_data(as_text=True)
+        self.assertNotIn(u"Parent post", data)
+
+    # several tags
+    def test_tag_intersection_and_union(self):
+        a, b = Tag(name=u"a"), Tag(name=u"b")
+        for name, tags in ((u"Only a", [a]), (u"Both", [a, b]), (u"Only b", [b])):
+            db.session.add(Post(name=name, body_md=u"body", status=True,
+                                author=self.author, tags=tags))
+        db.session.commit()
+        titles = lambda url: sorted(re.findall(r'>((?:Only \w|Both))</a>',
+                                               self.client.get(url).get_data(as_text=True)))
+        self.assertEqual(titles('/tag/a'), [u"Both", u"Only a"])
+        self.assertEqual(titles('/tag/a+b'), [u"Both"])
+        self.assertEqual(titles('/tag/a,b'), [u"Both", u"Only a", u"Only b"])
+        self.assertEqual(self.client.get('/tag/a+nope').status_code, 404)
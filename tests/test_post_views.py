@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+from werkzeug.datastructures import FileStorage
+from flask.ext.sqlalchemy import get_debug_queries
+from flask.ext.uploads import configure_uploads
+from app import create_app, db, images, imaging
+from app.models.users import Role, User
+from app.models.content import Post, Tag, Image
+from app.bp_post.views import set_tags
+
+
+class PostViewsTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.author = User(email=u"u@example.com", username=u"u", password=u"cat")
+        db.session.add(self.author)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def queries(self, *words):
+        return [q for q in get_debug_queries()[self.before:]
+                if all(w in q.statement for w in words)]
+
+    # set_tags
+    def test_set_tags_only_writes_changes(self):
+        post = Post(name=u"post", body_md=u"body", author=self.author)
+        set_tags(post, [u"a", u"b", u"a"])
+        db.session.add(post)
+        db.session.commit()
+        self.assertEqual(sorted(t.name for t in post.tags), [u"a", u"b"])
+        a, b = Tag.query.order_by(Tag.name).all()
+        self.before = len(get_debug_queries())
+        set_tags(post, [u"b", u"c"])
+        db.session.commit()
+        self.assertEqual(len(self.queries("FROM menuitem JOIN tag", " IN (")), 1)
+        [delete] = self.queries("DELETE FROM post_tag")
+        self.assertEqual(delete.parameters, (post.id, a.id))
+        [insert] = self.queries("INSERT INTO post_tag")
+        self.assertNotIn(b.id, insert.parameters)
+        self.assertEqual(sorted(t.name for t in post.tags), [u"b", u"c"])
+
+    # uploads
+    def test_uploads_are_stored_once_by_content(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.app.config['UPLOADED_IMAGES_DEST'] = directory
+            configure_uploads(self.app, images)
+            upload = lambda name: FileStorage(BytesIO(b"not really a photo"), name)
+            a = Image.from_upload(upload(u"photo.JPG"), alternative=u"a")
+            db.session.add(a)
+            db.session.commit()
+            self.assertRegexpMatches(a.filename, r"^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$")
+            self.assertTrue(a.filename.startswith(a.upload_digest[:2] + "/" + a.upload_digest[2:4]))
+            self.assertTrue(os.path.exists(images.path(a.filename)))
+            self.assertIs(Image.from_upload(upload(u"photo_1.jpg"), caption=u"c"), a)
+            self.assertEqual((a.alternative, a.caption), (u"a", u"c"))
+            self.assertEqual(Image.query.count(), 1)
+            self.assertEqual(a.digest, imaging.file_digest(images.path(a.filename)))
+        finally:
+            shutil.rmtree(directory)